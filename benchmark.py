@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# 基准测试：生成可复现的合成 EPUB 语料，分阶段计时 epub_series_editor 的处理流程，输出 JSON
+import argparse,os,sys,json,time,random,shutil,tempfile,zipfile,pathlib
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+import epub_series_editor as E
+try:
+    import resource
+except ImportError:
+    resource=None
+
+OPF_HEAD='''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+    <dc:identifier id="bookid">urn:uuid:{uid}</dc:identifier>
+    <dc:title>{title}</dc:title>
+    <dc:language>zh</dc:language>
+{meta}  </metadata>
+  <manifest>
+{items}  </manifest>
+  <spine>
+{spine}  </spine>
+</package>
+'''
+CONTAINER='<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>'
+
+CHUNK=1<<20
+def write_asset(z,name,size,rnd):
+    # 大体积不压缩资源按块流式写入，生成多GB的书也不占用相应内存
+    zi=zipfile.ZipInfo(name); zi.compress_type=zipfile.ZIP_STORED
+    block=rnd.randbytes(CHUNK)
+    with z.open(zi,"w",force_zip64=size>=zipfile.ZIP64_LIMIT) as w:
+        left=size
+        while left:
+            n=min(CHUNK,left); w.write(block[:n]); left-=n
+
+def make_book(path,rnd,size,entries,media_ratio,opf_items,meta_tags,existing,asset_size=0):
+    # size 为内容条目的总字节数（未压缩），按 media_ratio 分为不压缩的随机“图片”与可压缩的 XHTML
+    n_media=int(round(entries*media_ratio)); n_text=max(1,entries-n_media)
+    per=max(1,size//max(1,entries))
+    meta="".join(f'    <meta property="dcterms:x{i}">v{i}</meta>\n' for i in range(meta_tags))
+    if existing:
+        meta+='    <meta property="belongs-to-collection" id="c1">旧系列</meta>\n    <meta refines="#c1" property="collection-type">series</meta>\n'
+        meta+='    <meta refines="#c1" property="group-position">1</meta>\n    <meta name="calibre:series" content="旧系列" />\n'
+    items="".join(f'    <item id="p{i}" href="p{i}.xhtml" media-type="application/xhtml+xml"/>\n' for i in range(opf_items))
+    spine="".join(f'    <itemref idref="p{i}"/>\n' for i in range(opf_items))
+    opf=OPF_HEAD.format(uid=rnd.getrandbits(64),title=os.path.basename(path),meta=meta,items=items,spine=spine)
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    with zipfile.ZipFile(path,"w") as z:
+        z.writestr(zipfile.ZipInfo("mimetype"),"application/epub+zip")
+        z.writestr("META-INF/container.xml",CONTAINER,compress_type=zipfile.ZIP_DEFLATED)
+        z.writestr("OEBPS/content.opf",opf,compress_type=zipfile.ZIP_DEFLATED)
+        for i in range(n_text):
+            para=f"<p>第{i}章 {rnd.random()}</p>\n"
+            z.writestr(f"OEBPS/p{i}.xhtml","<html><body>"+para*(per//len(para.encode())+1)+"</body></html>",compress_type=zipfile.ZIP_DEFLATED)
+        for i in range(n_media):
+            z.writestr(f"OEBPS/img/{i}.jpg",rnd.randbytes(per),compress_type=zipfile.ZIP_STORED)
+        if asset_size:
+            write_asset(z,"OEBPS/img/plate.tif",asset_size,rnd)
+
+def make_corpus(root,args):
+    rnd=random.Random(args.seed)
+    for b in range(args.books):
+        folder=os.path.join(root,f"系列{b//args.per_folder:03d}")
+        make_book(os.path.join(folder,f"卷{b%args.per_folder:03d}.epub"),rnd,args.size,args.entries,args.media_ratio,
+                  args.opf_items,args.meta_tags,rnd.random()<args.existing,args.asset_size)
+
+def peak_rss_mb():
+    if resource is None: return None
+    r=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    return round(r/(1<<20) if sys.platform=="darwin" else r/1024,1)
+
+def run(root,args):
+    stages={k:0.0 for k in ("find_epubs","find_opf","parse","inject","write_epub","backup")}
+    t=time.perf_counter()
+    files=list(E.find_epubs(root,True))
+    stages["find_epubs"]=time.perf_counter()-t
+    total=sum(os.path.getsize(f) for f in files)
+    bakdir=tempfile.mkdtemp(prefix="esebak_")
+    try:
+        for i,f in enumerate(files):
+            t=time.perf_counter()
+            book=E.EpubBook(f).open()
+            opf,data=book.read_opf()
+            t1=time.perf_counter()
+            E.get_series_state(E.parse_opf_metadata(data))
+            t2=time.perf_counter()
+            new=E.inject_series_minimal(data,"基准系列",i+1,True,args.write_calibre)
+            t3=time.perf_counter()
+            E.write_epub(f,opf,new,backup=False,in_place=args.in_place,book=book)
+            t4=time.perf_counter()
+            shutil.copy2(f,os.path.join(bakdir,f"{i}.bak"))
+            t5=time.perf_counter()
+            stages["find_opf"]+=t1-t; stages["parse"]+=t2-t1; stages["inject"]+=t3-t2
+            stages["write_epub"]+=t4-t3; stages["backup"]+=t5-t4
+    finally:
+        shutil.rmtree(bakdir,ignore_errors=True)
+    work=sum(v for k,v in stages.items() if k!="backup")
+    mb=total/(1<<20)
+    return {
+        "books":len(files),"bytes":total,
+        "stages_s":{k:round(v,6) for k,v in stages.items()},
+        "per_book_ms":{k:round(v*1000/max(1,len(files)),4) for k,v in stages.items()},
+        "books_per_s":round(len(files)/work,2) if work else None,
+        "mb_per_s":round(mb/work,2) if work else None,
+        "peak_rss_mb":peak_rss_mb(),
+    }
+
+def main():
+    ap=argparse.ArgumentParser(description="epub_series_editor 基准测试：生成合成EPUB语料并分阶段计时，输出JSON")
+    ap.add_argument("--books",type=int,default=50,help="书籍数量(默认50)")
+    ap.add_argument("--per-folder",type=int,default=10,help="每个系列文件夹的书数(默认10)")
+    ap.add_argument("--size",type=int,default=4<<20,help="每本书内容条目的总字节数(默认4MB)")
+    ap.add_argument("--entries",type=int,default=40,help="每本书的内容条目数(默认40)")
+    ap.add_argument("--media-ratio",type=float,default=0.5,help="不压缩媒体条目的比例(默认0.5)")
+    ap.add_argument("--asset-size",type=int,default=0,help="每本额外加入一个该大小的不压缩大资源(字节，可超过4GB)，用于检验内存上限")
+    ap.add_argument("--buffer-size",type=int,help="复制条目的分块大小(字节，默认沿用epub_series_editor.COPY_BUFSIZE)")
+    ap.add_argument("--compression",choices=E.COMPRESSION_MODES,default="preserve",help="重写归档时的压缩策略(默认preserve)")
+    ap.add_argument("--compress-level",type=int,default=E.COMPRESS_LEVEL,help=f"重新压缩的级别(默认{E.COMPRESS_LEVEL})")
+    ap.add_argument("--compress-threads",type=int,help="重新压缩的线程数(默认：repack 时为CPU核数，否则为1)")
+    ap.add_argument("--max-rss",type=float,metavar="MB",help="峰值内存上限(MB)；超过时以状态码1退出，可用于发布前检查")
+    ap.add_argument("--opf-items",type=int,default=40,help="OPF manifest/spine 条目数，用于控制OPF大小(默认40)")
+    ap.add_argument("--meta-tags",type=int,default=10,help="OPF metadata 中额外的meta标签数(默认10)")
+    ap.add_argument("--existing",type=float,default=0.5,help="已有系列标签的书籍比例(默认0.5)")
+    ap.add_argument("--seed",type=int,default=1,help="随机种子(默认1)")
+    ap.add_argument("--write-calibre",action="store_true",help="同时写入calibre系列标签")
+    ap.add_argument("--in-place",action="store_true",help="使用原地修改写回")
+    ap.add_argument("--dir",help="语料目录(默认临时目录，结束后删除)")
+    ap.add_argument("--keep",action="store_true",help="保留生成的语料")
+    ap.add_argument("--output","-o",help="JSON结果输出文件(默认标准输出)")
+    args=ap.parse_args()
+    if args.buffer_size: E.COPY_BUFSIZE=args.buffer_size
+    E.COMPRESSION=args.compression; E.COMPRESS_LEVEL=args.compress_level
+    E.COMPRESS_THREADS=max(1,args.compress_threads or ((os.cpu_count() or 1) if args.compression=="repack" else 1))
+    root=args.dir or tempfile.mkdtemp(prefix="esebench_")
+    failed=False
+    try:
+        t=time.perf_counter()
+        make_corpus(root,args)
+        gen=time.perf_counter()-t
+        res=run(root,args)
+        res["generate_s"]=round(gen,3)
+        res["params"]={k:v for k,v in vars(args).items() if k not in ("dir","keep","output")}
+        res["python"]=sys.version.split()[0]
+        res["buffer_size"]=E.COPY_BUFSIZE
+        res["compress_threads"]=E.COMPRESS_THREADS
+        if args.max_rss is not None:
+            # 无法测量峰值内存的平台上不做判断
+            res["rss_ok"]=None if res["peak_rss_mb"] is None else res["peak_rss_mb"]<=args.max_rss
+            failed=res["rss_ok"] is False
+        out=json.dumps(res,ensure_ascii=False,indent=2)
+        if args.output:
+            pathlib.Path(args.output).write_text(out+"\n",encoding="utf-8")
+        else:
+            print(out)
+    finally:
+        if not args.keep and not args.dir:
+            shutil.rmtree(root,ignore_errors=True)
+    if failed:
+        print(f"峰值内存超过上限 {args.max_rss}MB",file=sys.stderr); sys.exit(1)
+
+if __name__=="__main__": main()
@@ -1,33 +1,78 @@
 #!/usr/bin/env python3
-import argparse,os,zipfile,xml.etree.ElementTree as ET,shutil,pathlib,sys
-import re,random,math
+import argparse,os,errno,zipfile,xml.etree.ElementTree as ET,shutil,pathlib,sys
+import re,math,struct,copy,json,threading,collections,hashlib,sqlite3,itertools,codecs,functools,time,asyncio,csv,contextlib,queue,html,unicodedata,difflib,tempfile,base64,zlib
+from concurrent.futures import ThreadPoolExecutor
 CALIBRE_NS="http://calibre.kovidgoyal.net/2009/metadata"
 ET.register_namespace("calibre", CALIBRE_NS)
 
+# OPF 编码：优先看 BOM，其次看无 BOM 的 UTF-16 特征与 XML 声明，默认 UTF-8
+_BOMS=((codecs.BOM_UTF32_LE,'utf-32-le'),(codecs.BOM_UTF32_BE,'utf-32-be'),(codecs.BOM_UTF8,'utf-8'),
+       (codecs.BOM_UTF16_LE,'utf-16-le'),(codecs.BOM_UTF16_BE,'utf-16-be'))
+_XML_DECL_ENC_RE=re.compile(rb'<\?xml\b[^>]*?\bencoding\s*=\s*["\']([A-Za-z][\w.\-]*)["\']')
+def opf_encoding(data):
+    # 返回 (编码名, BOM 字节数)
+    for bom,enc in _BOMS:
+        if data.startswith(bom): return enc,len(bom)
+    if data[:4]==b'<\x00?\x00': return 'utf-16-le',0
+    if data[:4]==b'\x00<\x00?': return 'utf-16-be',0
+    m=_XML_DECL_ENC_RE.match(data[:200].lstrip())
+    if m:
+        try:
+            return codecs.lookup(m.group(1).decode('ascii')).name,0
+        except LookupError:
+            pass
+    return 'utf-8',0
+@functools.lru_cache(maxsize=None)
+def _ascii_compatible(enc):
+    # 标签与 ASCII 字符编码后字节不变（UTF-8、GBK、Shift_JIS、Latin-1 等），可直接按字节编辑
+    probe='<?xml metadata/>="\' \t\r\n:-_#'
+    try:
+        return probe.encode(enc)==probe.encode('ascii') and not enc.startswith(('utf-16','utf-32'))
+    except (LookupError,UnicodeError):
+        return False
+@functools.lru_cache(maxsize=None)
+def _expat_decodes(enc):
+    # expat 只支持单字节编码与 UTF-8/16，GBK 等多字节编码需先解码为文本再解析
+    try:
+        ET.XMLParser().feed(f'<?xml version="1.0" encoding="{enc}"?>'.encode('ascii'))
+        return True
+    except (ValueError,LookupError):
+        return False
+def _opf_text(data):
+    # 无法按字节处理的编码（UTF-16/32 等）：严格解码，不再以替换字符掩盖错误
+    enc,bom=opf_encoding(data)
+    return data[bom:].decode(enc),enc,data[:bom]
+
+def _dedupe_tag(tag_name, s):
+    # s 可为 str 或 bytes，按原类型处理
+    B=isinstance(s,bytes)
+    pattern=rf'<((?:[A-Za-z_][\w\-]*:)?{tag_name})\b([^>]*)>'
+    attr_re=r'([^\s=]+)\s*=\s*("[^"]*"|\'[^\']*\')'
+    if B: pattern,attr_re=pattern.encode(),attr_re.encode()
+    sp,eq,lt,gt=(b' ',b'=',b'<',b'>') if B else (' ','=','<','>')
+    def repl(m):
+        qname=m.group(1)
+        attrs=m.group(2)
+        parts=list(re.finditer(attr_re, attrs))
+        seen=set(); out=[]
+        for mm in parts:
+            name=mm.group(1); val=mm.group(2)
+            if name not in seen:
+                seen.add(name)
+                out.append(name+eq+val)
+        new_attrs=(sp + sp.join(out)) if out else sp[:0]
+        return lt+qname+new_attrs+gt
+    return re.sub(pattern, repl, s, flags=re.IGNORECASE)
 def sanitize_opf_xml(data_bytes):
     # 针对某些 OPF 在 <package>/<metadata> 标签中重复声明属性（例如重复的 xmlns:opf），进行一次性去重
-    try:
-        s=data_bytes.decode('utf-8')
-    except UnicodeDecodeError:
-        s=data_bytes.decode('utf-8', errors='replace')
-    def dedupe_tag(tag_name, s):
-        pattern=rf'<((?:[A-Za-z_][\w\-]*:)?{tag_name})\b([^>]*)>'
-        def repl(m):
-            qname=m.group(1)
-            attrs=m.group(2)
-            parts=list(re.finditer(r'([^\s=]+)\s*=\s*("[^"]*"|\'[^\']*\')', attrs))
-            seen=set(); out=[]
-            for mm in parts:
-                name=mm.group(1); val=mm.group(2)
-                if name not in seen:
-                    seen.add(name)
-                    out.append(f"{name}={val}")
-            new_attrs=(' ' + ' '.join(out)) if out else ''
-            return f'<{qname}{new_attrs}>'
-        return re.sub(pattern, repl, s, flags=re.IGNORECASE)
-    s=dedupe_tag('package', s)
-    s=dedupe_tag('metadata', s)
-    return s.encode('utf-8')
+    # 保持原编码：ASCII 兼容编码直接处理字节，其余编码解码后处理再按原编码写回
+    enc,_=opf_encoding(data_bytes)
+    if _ascii_compatible(enc):
+        return _dedupe_tag('metadata', _dedupe_tag('package', data_bytes))
+    s,enc,bom=_opf_text(data_bytes)
+    s=_dedupe_tag('package', s)
+    s=_dedupe_tag('metadata', s)
+    return bom+s.encode(enc)
 def find_opf(z):
     try:
         data=z.read("META-INF/container.xml")
@@ -37,16 +82,49 @@ def find_opf(z):
         for name in z.namelist():
             if name.lower().endswith(".opf"): return name
         raise RuntimeError("未找到OPF")
+def _fromstring(data):
+    enc,bom=opf_encoding(data)
+    return ET.fromstring(data if _expat_decodes(enc) else data[bom:].decode(enc))
 def parse_opf(data):
     try:
-        root=ET.fromstring(data)
+        root=_fromstring(data)
     except ET.ParseError:
         # 回退：清理开头标签可能重复的属性（如重复的 xmlns: 前缀声明）后重试
         data=sanitize_opf_xml(data)
-        root=ET.fromstring(data)
+        root=_fromstring(data)
     meta=root.find(".//{*}metadata")
     if meta is None: raise RuntimeError("OPF缺少metadata")
     return root,meta
+METADATA_END_RE=re.compile(rb'</(?:[A-Za-z_][\w\-]*:)?metadata\s*>',re.IGNORECASE)
+def parse_opf_metadata(data,stats=None):
+    # 只解析到 </metadata>：先按字节定位结束标签，只把此前的部分喂给 XMLPullParser，不解析 manifest/spine
+    m=METADATA_END_RE.search(data)
+    cut=m.end() if m else len(data)
+    enc,bom=opf_encoding(data)
+    # GBK 等 expat 不支持的编码按声明解码为文本后再解析
+    text=not _expat_decodes(enc)
+    for attempt in (0,1):
+        # 回退：清理开头标签可能重复的属性后重试（只需处理 </metadata> 之前的部分）
+        head=sanitize_opf_xml(data[:cut]) if attempt else data[:cut]
+        if text: head=head[bom:].decode(enc)
+        parser=ET.XMLPullParser(events=("start","end"))
+        target=None
+        try:
+            # 结束标签可能出现在注释等位置，未取得完整 metadata 时继续喂入剩余内容
+            for part in (0,1):
+                parser.feed(head if part==0 else (data[cut:].decode(enc) if text else data[cut:]))
+                for ev,el in parser.read_events():
+                    if target is None and ev=="start" and (el.tag=="metadata" or el.tag.endswith("}metadata")):
+                        target=el
+                    elif ev=="end" and el is target:
+                        return el
+            parser.close()
+        except ET.ParseError:
+            if attempt: raise
+            if stats is not None: stats["sanitized"]=True
+            continue
+        break
+    raise RuntimeError("OPF缺少metadata")
 def get_series(meta):
     for e in meta.findall(".//{*}meta"):
         prop=e.get("property")
@@ -58,55 +136,1279 @@ def get_series(meta):
         if (e.get("name")=="calibre:series") or (e.get("property")=="calibre:series"):
             return e.get("content") or (e.text or "")
     return None
-def write_epub(epub_path,opf_path,new_opf,backup=True,backup_dir=None,backup_base=None):
+def get_series_state(meta):
+    # 读取两类系列标签的当前值：EPUB3 的 belongs-to-collection/group-position 与 calibre:series/series_index
+    st={"collection":None,"position":None,"calibre":None,"calibre_index":None}
+    metas=meta.findall(".//{*}meta")
+    cid=None
+    for e in metas:
+        if (e.get("property") or "").lower()=="belongs-to-collection":
+            st["collection"]=e.text or ""; cid=e.get("id"); break
+    if st["collection"] is not None:
+        for e in metas:
+            if (e.get("property") or "").lower()=="group-position" and (not cid or e.get("refines")=="#"+cid):
+                st["position"]=(e.text or "").strip(); break
+    for e in list(meta):
+        if CALIBRE_NS in e.tag:
+            if e.tag.endswith("}series") and st["calibre"] is None: st["calibre"]=e.text or ""
+            elif e.tag.endswith("}series_index") and st["calibre_index"] is None: st["calibre_index"]=(e.text or "").strip()
+    for e in metas:
+        key=e.get("name") or e.get("property")
+        if key=="calibre:series" and st["calibre"] is None:
+            st["calibre"]=e.get("content") or (e.text or "")
+        elif key=="calibre:series_index" and st["calibre_index"] is None:
+            st["calibre_index"]=(e.get("content") or (e.text or "")).strip()
+    return st
+def _same_index(a,b):
+    if a is None or b is None: return a is None and b is None
+    try:
+        return float(a)==float(b)
+    except (TypeError,ValueError):
+        return str(a).strip()==str(b).strip()
+def series_state_matches(state,series,index=None,write_collection=True,write_calibre=False):
+    # 目标系列与序号是否已完全写入（序号按数值比较，未指定序号时要求原文件也没有序号）
+    if write_collection and not (state.get("collection")==series and _same_index(state.get("position"),index)): return False
+    if write_calibre and not (state.get("calibre")==series and _same_index(state.get("calibre_index"),index)): return False
+    return True
+
+class ScanCache:
+    # 持久化扫描索引：以 (路径, 大小, mtime_ns, inode) 为键缓存 OPF 路径、系列状态与 OPF 摘要，未变化的书无需再打开
+    COMMIT_EVERY=500
+    def __init__(self,db_path):
+        self.db=sqlite3.connect(db_path,check_same_thread=False)
+        self.lock=threading.Lock()
+        self.pending=0
+        self.db.execute("CREATE TABLE IF NOT EXISTS books(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, opf TEXT, collection TEXT, position TEXT, calibre TEXT, calibre_index TEXT, digest TEXT)")
+        self.db.commit()
+    @staticmethod
+    def default_path(target):
+        p=pathlib.Path(target)
+        return str((p if p.is_dir() else p.parent)/".epub_series_index.sqlite")
+    def lookup(self,path,st):
+        with self.lock:
+            row=self.db.execute("SELECT size,mtime_ns,inode,opf,collection,position,calibre,calibre_index,digest FROM books WHERE path=?",(os.path.abspath(path),)).fetchone()
+        if not row or tuple(row[:3])!=(st.st_size,st.st_mtime_ns,st.st_ino): return None
+        return dict(zip(("opf","collection","position","calibre","calibre_index","digest"),row[3:]))
+    def store(self,path,st,opf,state,digest):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO books VALUES (?,?,?,?,?,?,?,?,?,?)",(os.path.abspath(path),st.st_size,st.st_mtime_ns,st.st_ino,opf,state["collection"],state["position"],state["calibre"],state["calibre_index"],digest))
+            self.pending+=1
+            if self.pending>=self.COMMIT_EVERY:
+                self.db.commit(); self.pending=0
+    def close(self):
+        with self.lock:
+            self.db.commit(); self.db.close()
+
+# 逐本计时：TIMING_HOOK 为可调用对象时，每本书处理结束以一条记录（dict）调用它；为 None 时不计时
+TIMING_HOOK=None
+def _new_stats():
+    return {"t0":time.perf_counter(),"stages":{},"bytes_read":0,"bytes_written":0,"entries":0,"sanitized":False} if TIMING_HOOK else None
+@contextlib.contextmanager
+def _timed(stats,stage):
+    if stats is None:
+        yield; return
+    t=time.perf_counter()
+    try:
+        yield
+    finally:
+        stats["stages"][stage]=stats["stages"].get(stage,0.0)+time.perf_counter()-t
+def _emit_timing(path,stats,result=None,error=None):
+    hook=TIMING_HOOK
+    if hook is None: return
+    rec={"path":path,"result":result,"error":None if error is None else f"{type(error).__name__}: {error}"}
+    if stats is not None:
+        rec["total_s"]=round(time.perf_counter()-stats["t0"],6)
+        rec["stages"]={k:round(v,6) for k,v in stats["stages"].items()}
+        rec.update({k:stats[k] for k in ("bytes_read","bytes_written","entries","sanitized")})
+    hook(rec)
+# 每本书的归档打开次数，用于确认单次处理只打开一次
+BOOK_OPENS=collections.Counter()
+_OPENS_LOCK=threading.Lock()
+class EpubBook:
+    # 书籍会话：只打开一次文件并读取一次中央目录，缓存条目列表、OPF 路径与内容，供检测、注入与写回共用
+    def __init__(self,path,writable=False):
+        self.path=path; self.writable=writable
+        self.fp=None; self.zf=None; self.opens=0; self.st=None
+        self.infos=None; self.start_dir=None
+        self.opf_path=None; self.opf_data=None
+        self.stats=_new_stats()
+    def open(self):
+        if self.fp is None:
+            with _timed(self.stats,"open"):
+                self.fp=open(self.path,"r+b" if self.writable else "rb")
+                self.opens+=1; self.st=os.fstat(self.fp.fileno())
+                with _OPENS_LOCK: BOOK_OPENS[os.path.abspath(self.path)]+=1
+                try:
+                    self.zf=zipfile.ZipFile(self.fp,"r")
+                    self.infos=self.zf.infolist(); self.start_dir=self.zf.start_dir
+                except BaseException:
+                    self.close(); raise
+            if self.stats is not None:
+                # 中央目录与结束记录
+                self.stats["entries"]=len(self.infos)
+                self.stats["bytes_read"]+=os.fstat(self.fp.fileno()).st_size-self.start_dir
+        return self
+    def read_opf(self):
+        if self.opf_data is None:
+            self.open()
+            with _timed(self.stats,"find_opf"):
+                self.opf_path=find_opf(self.zf)
+            with _timed(self.stats,"read"):
+                self.opf_data=self.zf.read(self.opf_path)
+            if self.stats is not None: self.stats["bytes_read"]+=self.zf.getinfo(self.opf_path).compress_size
+        return self.opf_path,self.opf_data
+    def unchanged(self):
+        # 会话仍打开，且打开后文件未被替换或改动（同一 inode、大小与修改时间）
+        if self.fp is None: return False
+        try:
+            st=os.stat(self.path)
+        except OSError:
+            return False
+        return (st.st_dev,st.st_ino,st.st_size,st.st_mtime_ns)==(self.st.st_dev,self.st.st_ino,self.st.st_size,self.st.st_mtime_ns)
+    def close(self):
+        if self.zf is not None: self.zf.close(); self.zf=None
+        if self.fp is not None: self.fp.close(); self.fp=None
+    def __enter__(self): return self.open()
+    def __exit__(self,*exc): self.close()
+
+# 原样复制与摘要计算的分块大小；条目无论多大都按此分块流式处理，单个线程的内存占用与归档大小无关
+COPY_BUFSIZE=1<<20
+def _strip_zip64_extra(extra):
+    # 去掉旧的 ZIP64 扩展字段（id=1），由写出端按新偏移量重新生成
+    out=[]; i=0
+    while i+4<=len(extra):
+        xid,xlen=struct.unpack('<HH',extra[i:i+4])
+        if xid!=1: out.append(extra[i:i+4+xlen])
+        i+=4+xlen
+    return b''.join(out)
+def _raw_limits(zr):
+    # 每个条目的原始字节不得越过下一个本地头或中央目录
+    infos=sorted(zr.infolist(), key=lambda i: i.header_offset)
+    ends=[i.header_offset for i in infos[1:]]+[zr.start_dir]
+    return {id(i):e for i,e in zip(infos,ends)}
+def _copy_raw(src,zw,info,limit):
+    # 原样复制本地头+压缩数据+CRC（含数据描述符），不解压也不重新压缩，仅在中央目录中登记新偏移
+    start=info.header_offset
+    src.seek(start)
+    head=src.read(30)
+    if len(head)<30 or head[:4]!=zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"本地文件头损坏: {info.filename}")
+    nlen,xlen=struct.unpack('<HH',head[26:30])
+    name_extra=src.read(nlen+xlen)
+    end=start+30+nlen+xlen+info.compress_size
+    if info.flag_bits & 0x08:
+        # 数据描述符：可选签名 + CRC + 大小（ZIP64 时为 8 字节）
+        lextra=name_extra[nlen:]; zip64=False; i=0
+        while i+4<=len(lextra):
+            xid,xl=struct.unpack('<HH',lextra[i:i+4])
+            if xid==1: zip64=True
+            i+=4+xl
+        src.seek(end)
+        end+=(4 if src.read(4)==b'PK\x07\x08' else 0)+(20 if zip64 else 12)
+    if end>limit:
+        raise zipfile.BadZipFile(f"条目数据越界: {info.filename}")
+    zi=copy.copy(info)
+    zi.extra=_strip_zip64_extra(info.extra)
+    zi.header_offset=zw.fp.tell()
+    zw.fp.write(head); zw.fp.write(name_extra)
+    src.seek(start+30+nlen+xlen)
+    left=end-(start+30+nlen+xlen)
+    while left:
+        chunk=src.read(min(COPY_BUFSIZE,left))
+        if not chunk: raise zipfile.BadZipFile(f"条目数据截断: {info.filename}")
+        zw.fp.write(chunk); left-=len(chunk)
+    zw.filelist.append(zi); zw.NameToInfo[zi.filename]=zi
+    zw.start_dir=zw.fp.tell(); zw._didModify=True
+    return end-start
+# 重写归档时的压缩策略：preserve 原样复制每个条目（默认）；store-media 把已压缩格式的媒体改为不压缩；
+# recompress 按 COMPRESS_LEVEL 重新压缩文本条目；repack 媒体不压缩、其余全部重新压缩（无收益时不压缩）
+COMPRESSION_MODES=("preserve","store-media","recompress","repack")
+COMPRESSION="preserve"
+COMPRESS_LEVEL=6
+# 重新压缩的线程数：zlib 压缩时释放 GIL，多个条目可并行压缩，仍按原顺序写出
+COMPRESS_THREADS=1
+# 不超过此大小的条目整块读入后交给线程压缩；更大的条目在当前线程流式处理
+RECODE_INMEM=4<<20
+MEDIA_EXTS={".jpg",".jpeg",".png",".gif",".webp",".avif",".woff",".woff2",".mp3",".m4a",".mp4",".m4v",".ogg",".opus",".webm",".zip",".gz"}
+TEXT_EXTS={".xhtml",".html",".htm",".xml",".opf",".ncx",".css",".svg",".js",".json",".txt",".smil",".pls"}
+def _entry_action(it):
+    # raw=原样复制，store=解压后不压缩写出，deflate=按 COMPRESS_LEVEL 重新压缩；加密或其他压缩方式的条目总是原样复制
+    mode=COMPRESSION
+    if mode=="preserve" or it.is_dir() or it.flag_bits&0x1 or it.compress_type not in (zipfile.ZIP_STORED,zipfile.ZIP_DEFLATED):
+        return "raw"
+    ext=os.path.splitext(it.filename)[1].lower()
+    if ext in MEDIA_EXTS:
+        return "store" if mode in ("store-media","repack") and it.compress_type!=zipfile.ZIP_STORED else "raw"
+    if mode=="repack" or (mode=="recompress" and ext in TEXT_EXTS): return "deflate"
+    return "raw"
+def _recode(raw,action,level):
+    # 在线程中执行：返回 (压缩方式, CRC, 数据)
+    crc=zlib.crc32(raw)
+    if action=="deflate":
+        c=zlib.compressobj(level,zlib.DEFLATED,-15)
+        data=c.compress(raw)+c.flush()
+        if len(data)<len(raw): return zipfile.ZIP_DEFLATED,crc,data
+    return zipfile.ZIP_STORED,crc,raw
+def _write_recoded(zw,it,size,method,crc,data):
+    zi=copy.copy(it); zi.extra=_strip_zip64_extra(it.extra)
+    zi.compress_type=method; zi.CRC=crc; zi.file_size=size; zi.compress_size=len(data)
+    zi.flag_bits&=~0x08; zi.header_offset=zw.fp.tell()
+    zw.fp.write(zi.FileHeader(False)); zw.fp.write(data)
+    zw.filelist.append(zi); zw.NameToInfo[zi.filename]=zi
+    zw.start_dir=zw.fp.tell(); zw._didModify=True
+def _recode_stream(zr,zw,it,action):
+    # 大条目流式重写；压缩无收益时撤回已写出的条目，改为不压缩重写一遍
+    for method in ((zipfile.ZIP_DEFLATED,zipfile.ZIP_STORED) if action=="deflate" else (zipfile.ZIP_STORED,)):
+        zi=copy.copy(it); zi.extra=_strip_zip64_extra(it.extra)
+        zi.compress_type=method; zi._compresslevel=COMPRESS_LEVEL
+        with zr.open(it) as src, zw.open(zi,"w") as dst:
+            shutil.copyfileobj(src,dst,COPY_BUFSIZE)
+        if method==zipfile.ZIP_STORED or zi.compress_size<zi.file_size: return
+        zw.filelist.pop(); zw.NameToInfo.pop(zi.filename,None)
+        zw.fp.seek(zi.header_offset); zw.fp.truncate(); zw.start_dir=zi.header_offset
+# 重新压缩的线程池由所有书共用：-j 并发处理多本书时，压缩线程总数仍为 COMPRESS_THREADS
+_DEFLATE_POOL=None
+_DEFLATE_LOCK=threading.Lock()
+def _deflate_pool():
+    global _DEFLATE_POOL
+    with _DEFLATE_LOCK:
+        if _DEFLATE_POOL is None:
+            _DEFLATE_POOL=ThreadPoolExecutor(max_workers=COMPRESS_THREADS,thread_name_prefix="esdeflate")
+        return _DEFLATE_POOL
+def _rewrite_entries(book,zw,opf_path,new_opf):
+    zr=book.zf; infos=book.infos
+    limits=_raw_limits(zr)
+    # EPUB 要求 mimetype 为第一个条目且不压缩
+    order=[it for it in infos if it.filename=="mimetype"]+[it for it in infos if it.filename!="mimetype"]
+    copied=0
+    recoding=COMPRESSION!="preserve"
+    pool=_deflate_pool() if recoding and COMPRESS_THREADS>1 else None
+    # 按原顺序待写出的条目：(条目, None=原样复制 | 重新压缩的结果或 Future, 原大小)；同时在压缩的条目不超过线程数的两倍
+    pending=collections.deque()
+    def flush(keep=0):
+        nonlocal copied
+        while len(pending)>keep:
+            it,job,size=pending.popleft()
+            if job is None:
+                copied+=_copy_raw(book.fp,zw,it,limits[id(it)])
+            else:
+                _write_recoded(zw,it,size,*(job.result() if pool else job))
+    for it in order:
+        if it.filename==opf_path:
+            flush()
+            zi=copy.copy(it); zi.extra=_strip_zip64_extra(it.extra)
+            if recoding and _entry_action(it)=="deflate":
+                zi.compress_type=zipfile.ZIP_DEFLATED; zi._compresslevel=COMPRESS_LEVEL
+            zw.writestr(zi,new_opf)
+        elif it.filename=="mimetype" and it.compress_type!=zipfile.ZIP_STORED:
+            flush()
+            zi=zipfile.ZipInfo("mimetype",it.date_time); zi.compress_type=zipfile.ZIP_STORED
+            zw.writestr(zi,zr.read(it))
+        else:
+            action=_entry_action(it) if it.filename!="mimetype" else "raw"
+            if action=="raw":
+                pending.append((it,None,None))
+            elif it.file_size>RECODE_INMEM:
+                flush(); _recode_stream(zr,zw,it,action); copied+=it.compress_size
+            else:
+                raw=zr.read(it); copied+=it.compress_size
+                pending.append((it,pool.submit(_recode,raw,action,COMPRESS_LEVEL) if pool else _recode(raw,action,COMPRESS_LEVEL),len(raw)))
+            flush(COMPRESS_THREADS*2)
+    flush()
+    # 返回从原归档读取的条目字节数
+    return copied
+def _backup_dest(epub_path,backup_dir=None,backup_base=None,suffix=".bak"):
+    dest=epub_path+suffix
+    if backup_dir:
+        try:
+            base=pathlib.Path(backup_base).resolve() if backup_base else pathlib.Path(epub_path).resolve().parent
+        except Exception:
+            base=pathlib.Path(epub_path).resolve().parent
+        p_epub=pathlib.Path(epub_path).resolve()
+        try:
+            rel=p_epub.relative_to(base)
+        except Exception:
+            rel=p_epub.name
+        dest_path=pathlib.Path(backup_dir).resolve()/rel
+        os.makedirs(str(dest_path.parent),exist_ok=True)
+        dest=str(dest_path)+suffix if not str(dest_path).endswith(".bak") else str(dest_path)
+    return dest
+
+# 原地修改的撤销记录：原中央目录位置与文件长度、原中央目录+结束记录字节，以及（备份时）原 OPF 内容
+TAIL_MAGIC=b"ESEJ1\n"
+def _tail_record(book,opf_path=None,with_opf=False):
+    start=book.start_dir
+    info=book.zf.getinfo(opf_path) if opf_path else None
+    opf_data=b""
+    if info and with_opf:
+        opf_data=book.opf_data if opf_path==book.opf_path else book.zf.read(info)
+    book.fp.seek(start); tail=book.fp.read()
+    head={"start_dir":start,"size":start+len(tail),"tail":len(tail),"opf":opf_path,
+          "opf_offset":info.header_offset if info else None,"opf_len":len(opf_data)}
+    return TAIL_MAGIC+json.dumps(head,ensure_ascii=False).encode('utf-8')+b"\n"+tail+opf_data
+def _parse_tail_record(rec):
+    if not rec.startswith(TAIL_MAGIC): raise RuntimeError("撤销记录格式错误")
+    nl=rec.index(b"\n",len(TAIL_MAGIC))
+    head=json.loads(rec[len(TAIL_MAGIC):nl].decode('utf-8'))
+    tail=rec[nl+1:nl+1+head["tail"]]
+    opf_data=rec[nl+1+head["tail"]:nl+1+head["tail"]+head["opf_len"]]
+    if len(tail)!=head["tail"] or len(opf_data)!=head["opf_len"]: raise RuntimeError("撤销记录不完整")
+    return head,tail,opf_data
+def _write_synced(path,data):
+    with open(path,"wb") as f:
+        f.write(data); f.flush(); os.fsync(f.fileno())
+def _restore_tail(epub_path,head,tail):
+    # 原地修改只写入原中央目录位置之后，截断并写回原尾部即可恢复
+    with open(epub_path,"r+b") as f:
+        f.seek(head["start_dir"]); f.truncate(); f.write(tail)
+        f.flush(); os.fsync(f.fileno())
+def _after_digest(epub_path,start):
+    # 修改后的尾部（原中央目录位置之后）长度与摘要；恢复时文件仍为这次修改的结果才按字节还原
+    with open(epub_path,"rb") as f:
+        f.seek(start); tail=f.read()
+    return start+len(tail),hashlib.sha1(tail).hexdigest()
+def restore_tail_record(epub_path,rec,after_size=None,after_sha1=None):
+    # 按撤销记录恢复；返回 "exact"（按字节还原）或 "opf"（文件之后被重写过，改为重写原 OPF）
+    # after_* 缺省时使用记录头中的值（.cd.bak 在原地修改完成后补记）
+    head,tail,opf_data=_parse_tail_record(rec)
+    after_size=after_size or head.get("after_size"); after_sha1=after_sha1 or head.get("after_sha1")
+    recover_inplace(epub_path)
+    if after_sha1 and os.path.getsize(epub_path)==after_size and _after_digest(epub_path,head["start_dir"])[1]==after_sha1:
+        _restore_tail(epub_path,head,tail)
+        return "exact"
+    write_epub(epub_path,head["opf"],opf_data,backup=False)
+    return "opf"
+def recover_inplace(epub_path):
+    # 若存在上次中断遗留的日志，则回滚到修改前的状态
+    jpath=epub_path+".journal"
+    if not os.path.exists(jpath): return False
+    with open(jpath,"rb") as f: rec=f.read()
+    try:
+        head,tail,_=_parse_tail_record(rec)
+    except Exception:
+        # 日志未完整写入时文件尚未被改动
+        os.remove(jpath); return False
+    _restore_tail(epub_path,head,tail)
+    os.remove(jpath)
+    return True
+def patch_epub_inplace(book,opf_path,new_opf,backup_dest=None):
+    # 将新 OPF 与新中央目录写到原中央目录处，其余字节不动；旧 OPF 成为死字节，可用 compact_epub 清除
+    # book 须以可写方式打开；沿用其已读取的中央目录，不再重新解析
+    old=book.zf.getinfo(opf_path)
+    rec=_tail_record(book,opf_path,with_opf=bool(backup_dest))
+    head,tail,_=_parse_tail_record(rec)
+    if backup_dest: _write_synced(backup_dest,rec)
+    jpath=book.path+".journal"
+    _write_synced(jpath,rec)
+    try:
+        f=book.fp
+        book.zf.close(); book.zf=None
+        f.seek(book.start_dir)
+        with zipfile.ZipFile(f,"w") as zw:
+            pos=0
+            for it in book.infos:
+                if it is old:
+                    pos=len(zw.filelist); continue
+                zi=copy.copy(it); zi.extra=_strip_zip64_extra(it.extra)
+                zw.filelist.append(zi); zw.NameToInfo[zi.filename]=zi
+            zi=copy.copy(old); zi.extra=_strip_zip64_extra(old.extra)
+            zw.writestr(zi,new_opf)
+            # 保持中央目录中的原有顺序
+            zw.filelist.insert(pos,zw.filelist.pop())
+        f.truncate(); f.flush(); os.fsync(f.fileno())
+    except BaseException:
+        book.close()
+        _restore_tail(book.path,head,tail)
+        os.remove(jpath)
+        raise
+    book.close()
+    os.remove(jpath)
+def compact_epub(epub_path):
+    # 原样复制中央目录引用的条目，丢弃原地修改留下的死字节
+    write_epub(epub_path,None,None,backup=False)
+def find_backup_file(epub_path,backup_dir=None,backup_base=None):
+    # 不使用备份库时的文件备份：<文件>.cd.bak（原地修改的撤销记录）或 <文件>.bak（整本副本），两者都有时取较晚生成的
+    # （.bak 由 copy2 复制，mtime 为原书的，故按 ctime 比较）
+    found=[p for p in (_backup_dest(epub_path,backup_dir,backup_base,".cd.bak"),_backup_dest(epub_path,backup_dir,backup_base)) if os.path.exists(p)]
+    return max(found,key=lambda p: os.stat(p).st_ctime) if found else None
+def restore_backup_file(epub_path,bak):
+    # 返回 "exact"/"opf"（见 restore_tail_record）或 "full"（整本替换）
+    if bak.endswith(".cd.bak"):
+        with open(bak,"rb") as f: return restore_tail_record(epub_path,f.read())
+    recover_inplace(epub_path)
     tmp=epub_path+".tmp"
-    with zipfile.ZipFile(epub_path,"r") as zr, zipfile.ZipFile(tmp,"w",compression=zipfile.ZIP_DEFLATED) as zw:
-        for it in zr.infolist():
-            data=zr.read(it.filename)
-            if it.filename==opf_path: data=new_opf
-            zw.writestr(it,data)
-    if backup:
-        dest=epub_path+".bak"
-        if backup_dir:
-            try:
-                base=pathlib.Path(backup_base).resolve() if backup_base else pathlib.Path(epub_path).resolve().parent
-            except Exception:
-                base=pathlib.Path(epub_path).resolve().parent
-            p_epub=pathlib.Path(epub_path).resolve()
-            try:
-                rel=p_epub.relative_to(base)
-            except Exception:
-                rel=p_epub.name
-            dest_path=pathlib.Path(backup_dir).resolve()/rel
-            os.makedirs(str(dest_path.parent),exist_ok=True)
-            dest=str(dest_path)+".bak" if not str(dest_path).endswith(".bak") else str(dest_path)
-        shutil.copy2(epub_path,dest)
-    os.replace(tmp,epub_path)
+    shutil.copy2(bak,tmp); os.replace(tmp,epub_path)
+    return "full"
+FICLONE=0x40049409
+def _clone_file(src,dst,allow_link=False):
+    # 依次尝试硬链接、reflink（Linux FICLONE，写时复制）与普通复制，返回实际使用的方式
+    if allow_link:
+        try:
+            os.link(src,dst); return "link"
+        except OSError:
+            pass
+    try:
+        import fcntl
+        with open(src,"rb") as s, open(dst,"wb") as d:
+            fcntl.ioctl(d.fileno(),FICLONE,s.fileno())
+        shutil.copystat(src,dst); return "reflink"
+    except (ImportError,OSError):
+        pass
+    shutil.copy2(src,dst); return "copy"
+class BackupStore:
+    # 内容寻址的备份库：对象按 SHA-256 存放于 objects/ab/cdef...，相同内容只存一份；备份记录存于 index.sqlite
+    # opf 模式只保存撤销记录（原中央目录+结束记录+原 OPF，格式同 .cd.bak），full 模式保存整本（优先硬链接/reflink）
+    def __init__(self,root,mode="opf"):
+        self.root=root; self.mode=mode
+        os.makedirs(os.path.join(root,"objects"),exist_ok=True)
+        self.db=sqlite3.connect(os.path.join(root,"index.sqlite"),check_same_thread=False)
+        self.lock=threading.Lock()
+        self.db.execute("CREATE TABLE IF NOT EXISTS refs(id INTEGER PRIMARY KEY, path TEXT, time REAL, mode TEXT, object TEXT, size INTEGER, start_dir INTEGER, after_size INTEGER, after_sha1 TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS refs_path ON refs(path)")
+        self.db.commit()
+    def _obj(self,h):
+        return os.path.join(self.root,"objects",h[:2],h[2:])
+    def _put(self,h,write):
+        # 已存在则直接复用；否则写入同目录临时文件再原子改名
+        dest=self._obj(h)
+        if os.path.exists(dest): return h
+        os.makedirs(os.path.dirname(dest),exist_ok=True)
+        tmp=f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            write(tmp); os.replace(tmp,dest)
+        finally:
+            if os.path.exists(tmp): os.remove(tmp)
+        return h
+    def save(self,book,opf_path,in_place=False):
+        # 在修改前调用；返回待登记的记录，写回成功后交给 commit
+        if self.mode=="opf":
+            rec=_tail_record(book,opf_path,with_opf=True)
+            h=self._put(hashlib.sha256(rec).hexdigest(),lambda p: _write_synced(p,rec))
+        else:
+            dig=hashlib.sha256(); f=book.fp; f.seek(0)
+            for chunk in iter(lambda: f.read(COPY_BUFSIZE),b""): dig.update(chunk)
+            # 原地修改会改动同一 inode，此时不能硬链接
+            h=self._put(dig.hexdigest(),lambda p: _clone_file(book.path,p,allow_link=not in_place))
+        return {"path":os.path.abspath(book.path),"mode":self.mode,"object":h,"size":os.path.getsize(book.path),"start_dir":book.start_dir}
+    def commit(self,ref,in_place=False):
+        after_size=after_sha1=None
+        if in_place and ref["mode"]=="opf":
+            # 记录修改后的尾部摘要，恢复时若文件仍是这次修改的结果即可按字节还原
+            after_size,after_sha1=_after_digest(ref["path"],ref["start_dir"])
+        with self.lock:
+            self.db.execute("INSERT INTO refs(path,time,mode,object,size,start_dir,after_size,after_sha1) VALUES (?,?,?,?,?,?,?,?)",
+                            (ref["path"],time.time(),ref["mode"],ref["object"],ref["size"],ref["start_dir"],after_size,after_sha1))
+            self.db.commit()
+    def latest(self,path):
+        with self.lock:
+            row=self.db.execute("SELECT mode,object,after_size,after_sha1 FROM refs WHERE path=? ORDER BY id DESC LIMIT 1",(os.path.abspath(path),)).fetchone()
+        return dict(zip(("mode","object","after_size","after_sha1"),row)) if row else None
+    def restore(self,path):
+        # 恢复最近一次备份；返回 "exact"（按字节还原）、"opf"（重写原 OPF）、"full"（整本替换）或 None（无备份）
+        ref=self.latest(path)
+        if ref is None: return None
+        obj=self._obj(ref["object"])
+        if ref["mode"]=="full":
+            recover_inplace(path)
+            dig=hashlib.sha256()
+            with open(obj,"rb") as f:
+                for chunk in iter(lambda: f.read(COPY_BUFSIZE),b""): dig.update(chunk)
+            if dig.hexdigest()!=ref["object"]: raise RuntimeError(f"备份对象已损坏: {obj}")
+            tmp=path+".tmp"
+            _clone_file(obj,tmp); os.replace(tmp,path)
+            return "full"
+        with open(obj,"rb") as f: rec=f.read()
+        return restore_tail_record(path,rec,ref["after_size"],ref["after_sha1"])
+    def gc(self,keep=1):
+        # 每本书只保留最近 keep 条记录，删除不再被引用的对象与中断遗留的临时文件；返回 (删除记录数, 删除对象数, 释放字节数)
+        with self.lock:
+            cur=self.db.execute("DELETE FROM refs WHERE id IN (SELECT id FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY path ORDER BY id DESC) AS n FROM refs) WHERE n>?)",(keep,))
+            dropped=cur.rowcount
+            self.db.commit()
+            live={r[0] for r in self.db.execute("SELECT DISTINCT object FROM refs")}
+        removed=freed=0
+        objdir=os.path.join(self.root,"objects")
+        for sub in os.scandir(objdir):
+            if not sub.is_dir(): continue
+            for e in os.scandir(sub.path):
+                if sub.name+e.name in live: continue
+                st=e.stat(); os.remove(e.path)
+                # 硬链接对象与书共用数据块，删除时并不释放空间
+                if not e.name.endswith(".tmp"): removed+=1
+                if st.st_nlink<=1: freed+=st.st_size
+            if not os.listdir(sub.path): os.rmdir(sub.path)
+        return dropped,removed,freed
+    def close(self):
+        with self.lock:
+            self.db.commit(); self.db.close()
+def write_epub(epub_path,opf_path,new_opf,backup=True,backup_dir=None,backup_base=None,in_place=False,book=None,store=None):
+    # book 为已打开的会话时直接复用其句柄与中央目录；写完后会关闭它
+    # 返回备份位置：备份文件路径、备份库对象（store:<sha256>）或 None
+    if book is None or (in_place and not book.writable):
+        stats=book.stats if book is not None else None
+        if book is not None: book.close()
+        recover_inplace(epub_path)
+        book=EpubBook(epub_path,writable=in_place)
+        if stats is not None: book.stats=stats
+    stats=book.stats
+    # 使用备份库时由库负责备份，不再生成 .bak/.cd.bak
+    ref=dest=None
+    try:
+        book.open()
+        if backup and store is not None:
+            with _timed(stats,"backup"):
+                ref=store.save(book,opf_path,in_place)
+        if in_place:
+            start=book.start_dir
+            if backup and store is None: dest=_backup_dest(epub_path,backup_dir,backup_base,".cd.bak")
+            with _timed(stats,"rewrite"):
+                patch_epub_inplace(book,opf_path,new_opf,dest)
+            if stats is not None: stats["bytes_written"]+=os.path.getsize(epub_path)-start
+            if dest:
+                # 与备份库相同，补记修改后的尾部摘要，供 --restore 判断能否按字节还原
+                with _timed(stats,"backup"):
+                    with open(dest,"rb") as f: head,tail,opf_data=_parse_tail_record(f.read())
+                    head["after_size"],head["after_sha1"]=_after_digest(epub_path,start)
+                    _write_synced(dest+".tmp",TAIL_MAGIC+json.dumps(head,ensure_ascii=False).encode('utf-8')+b"\n"+tail+opf_data)
+                    os.replace(dest+".tmp",dest)
+        else:
+            tmp=epub_path+".tmp"
+            with _timed(stats,"rewrite"):
+                with zipfile.ZipFile(tmp,"w",compression=zipfile.ZIP_DEFLATED) as zw:
+                    copied=_rewrite_entries(book,zw,opf_path,new_opf)
+            if stats is not None:
+                stats["bytes_read"]+=copied; stats["bytes_written"]+=os.path.getsize(tmp)
+    finally:
+        book.close()
+    if not in_place:
+        if backup and store is None:
+            with _timed(stats,"backup"):
+                dest=_backup_dest(epub_path,backup_dir,backup_base)
+                shutil.copy2(epub_path,dest)
+        with _timed(stats,"rename"):
+            os.replace(tmp,epub_path)
+    if ref is not None:
+        with _timed(stats,"backup"):
+            store.commit(ref,in_place)
+        dest="store:"+ref["object"]
+    return dest
 POLICY_FORCE_ALL=False
-def process_file(path,series=None,index=None,force=False,skip=False,dry=False,backup=True,backup_dir=None,backup_base=None,write_collection=True,write_calibre=False):
+# 已有系列的提问需串行进行，并与结果输出互斥
+PROMPT_LOCK=threading.RLock()
+def confirm_replace(path,old,val):
+    # 询问是否把已有系列替换为 val；回答 a 后不再询问
     global POLICY_FORCE_ALL
-    with zipfile.ZipFile(path,"r") as z:
-        opf=find_opf(z); data=z.read(opf)
-    root,meta=parse_opf(data)
-    val=series or pathlib.Path(path).parent.name
-    old=get_series(meta)
-    if old and skip: return f"跳过(已有): {path}"
-    if old and not (force or POLICY_FORCE_ALL):
+    with PROMPT_LOCK:
+        if POLICY_FORCE_ALL: return True
         print(f"提示: {path} 已有系列: {old}")
-        ans=input(f"是否替换为 '{val}'? [y/N/a/skip]: ").strip().lower()
-        if ans=="skip": return f"跳过(用户): {path}"
+        try:
+            ans=input(f"是否替换为 '{val}'? [y/N/a/skip]: ").strip().lower()
+        except EOFError:
+            # 输入已结束（管道或脚本中的回答用完）：按默认不替换
+            print(); ans="n"
         if ans=="a": POLICY_FORCE_ALL=True
-        elif ans!="y": return f"跳过(用户): {path}"
-    # 使用最小注入生成新的 OPF 内容，避免重序列化导致的其他改动
-    new=inject_series_minimal(data, val, index, write_collection=write_collection, write_calibre=write_calibre)
-    if dry: return f"预览: {path} -> {val}"
-    write_epub(path,opf,new,backup,backup_dir,backup_base)
-    return f"完成: {path} -> {val}"
+        return ans in ("y","a")
+class NeedsConfirm:
+    # 已有系列、需要询问是否替换的书：工作线程不提问，会话保持打开，由主线程按输入顺序询问后继续
+    def __init__(self,book,val,old,edits=()):
+        self.book,self.val,self.old=book,val,old
+        self.job=(book,val)
+        self.edits=edits
+    def decline(self):
+        # 不替换系列：有字段编辑时返回只编辑字段的作业，否则返回跳过结果
+        return _skip_series(self.book,self.edits,f"跳过(用户): {self.book.path}")
+def _skip_series(book,edits,res):
+    # 保留已有系列时字段编辑照常执行（系列名为 None 表示不写系列标签）；编辑不改变内容时才整本跳过
+    try:
+        if edits and edit_opf_minimal(book.opf_data,edits)!=book.opf_data: return book,None
+    except BaseException as e:
+        book.close(); _emit_timing(book.path,book.stats,error=e); raise
+    book.close(); _emit_timing(book.path,book.stats,res)
+    return res
+def prepare_file(path,series=None,index=None,force=False,skip=False,dry=False,write_collection=True,write_calibre=False,in_place=False,cache=None,edits=(),ask=True,book=None):
+    # 读取阶段：返回结果字符串表示无需写回；否则返回 (仍打开的书会话, 系列名)，交给 edit_file 与 commit_file
+    # edits 为其他字段的编辑（见 apply_field_edit），与系列标签在同一次写回中完成；两类系列标签都不写时只执行 edits
+    # ask=False 时不在此提问：需要确认替换的书返回 NeedsConfirm，由调用方询问；book 为调用方已打开的会话（如交互模式统计系列时）
+    recover_inplace(path)
+    val=series or pathlib.Path(path).parent.name
+    # 索引只记录系列状态，有其他字段编辑时仍需打开检查
+    if cache is not None and not edits:
+        st=os.stat(path)
+        rec=cache.lookup(path,st)
+        if rec and series_state_matches(rec,val,index,write_collection,write_calibre):
+            res=f"跳过(未变化): {path}"
+            _emit_timing(path,None,res); return res
+    book=book or EpubBook(path,writable=in_place and not dry)
+    try:
+        book.open()
+        opf,data=book.read_opf()
+        with _timed(book.stats,"parse"):
+            meta=parse_opf_metadata(data,book.stats)
+        state=get_series_state(meta)
+        if cache is not None:
+            cache.store(path,os.stat(path),opf,state,hashlib.sha1(data).hexdigest())
+        old=get_series(meta) if write_collection or write_calibre else None
+        res=None
+        # 目标系列与序号已完全写入、其他字段编辑也不改变内容时不再重写归档
+        if series_state_matches(state,val,index,write_collection,write_calibre) and (not edits or edit_opf_minimal(data,edits)==data):
+            res=f"跳过(无需修改): {path}"
+        elif old and skip: return _skip_series(book,edits,f"跳过(已有): {path}")
+        elif old and not (force or POLICY_FORCE_ALL):
+            if not ask: return NeedsConfirm(book,val,old,edits)
+            if not confirm_replace(path,old,val): return _skip_series(book,edits,f"跳过(用户): {path}")
+    except BaseException as e:
+        book.close(); _emit_timing(path,book.stats,error=e); raise
+    if res is not None:
+        book.close(); _emit_timing(path,book.stats,res); return res
+    return book,val
+def edit_file(job,index=None,dry=False,write_collection=True,write_calibre=False,edits=()):
+    # 编辑阶段（纯 CPU）：使用最小注入生成新的 OPF 内容，避免重序列化导致的其他改动
+    book,val=job
+    try:
+        with _timed(book.stats,"inject"):
+            new=edit_opf_minimal(book.opf_data, edits, val, index, write_collection=write_collection, write_calibre=write_calibre)
+    except BaseException as e:
+        book.close(); _emit_timing(book.path,book.stats,error=e); raise
+    if val is None or not (write_collection or write_calibre):
+        # 不写系列时结果中列出编辑的字段，而不是未写入的系列名；计划记录与日志同样使用该描述
+        val="编辑: "+", ".join(dict.fromkeys(e[1] for e in edits))+("（保留已有系列）" if val is None else "")
+    if dry:
+        book.close(); res=f"预览: {book.path} -> {val}"
+        _emit_timing(book.path,book.stats,res); return res
+    return book,val,new
+def commit_file(job,backup=True,backup_dir=None,backup_base=None,in_place=False,cache=None,store=None,journal=None):
+    # 写回阶段：write_epub 结束时关闭书会话
+    book,val,new=job
+    path,opf,stats=book.path,book.opf_path,book.stats
+    try:
+        if journal is not None: journal.log("plan",path,series=val)
+        dest=write_epub(path,opf,new,backup,backup_dir,backup_base,in_place=in_place,book=book,store=store)
+        if journal is not None: journal.log("commit",path,backup=dest)
+        if cache is not None:
+            cache.store(path,os.stat(path),opf,get_series_state(parse_opf_metadata(new)),hashlib.sha1(new).hexdigest())
+    except BaseException as e:
+        _emit_timing(path,stats,error=e); raise
+    res=f"完成: {path} -> {val}"
+    _emit_timing(path,stats,res)
+    return res
+def process_file(path,series=None,index=None,force=False,skip=False,dry=False,backup=True,backup_dir=None,backup_base=None,write_collection=True,write_calibre=False,in_place=False,cache=None,store=None,journal=None,edits=(),ask=True):
+    job=prepare_file(path,series,index,force,skip,dry,write_collection,write_calibre,in_place,cache,edits,ask)
+    if isinstance(job,(str,NeedsConfirm)): return job
+    return finish_file(job,index,dry,backup,backup_dir,backup_base,write_collection,write_calibre,in_place,cache,store,journal,edits)
+def finish_file(job,index=None,dry=False,backup=True,backup_dir=None,backup_base=None,write_collection=True,write_calibre=False,in_place=False,cache=None,store=None,journal=None,edits=()):
+    # prepare_file 之后的编辑与写回
+    job=edit_file(job,index,dry,write_collection,write_calibre,edits)
+    if isinstance(job,str): return job
+    return commit_file(job,backup,backup_dir,backup_base,in_place,cache,store,journal)
+# 规划与提交分离：规划阶段做出全部决定并生成新的 OPF 内容（计划记录），提交阶段再写回，可在后台进行或保存为计划文件稍后执行
+def plan_file(path,series=None,index=None,force=False,skip=False,write_collection=True,write_calibre=False,cache=None,edits=(),ask=True,book=None,keep=False):
+    # 返回结果字符串（无需写回）或计划记录；记录中的 digest 为规划时原 OPF 的摘要，提交前据此确认书未被改动
+    job=prepare_file(path,series,index,force,skip,False,write_collection,write_calibre,False,cache,edits,ask,book)
+    if isinstance(job,(str,NeedsConfirm)): return job
+    return plan_record(job,index,write_collection,write_calibre,edits,keep)
+def plan_record(job,index=None,write_collection=True,write_calibre=False,edits=(),keep=False):
+    # keep=True 时会话保持打开并随记录交给同一进程内的提交（PlanCommitter），不必重新打开
+    book,val,new=edit_file(job,index,False,write_collection,write_calibre,edits)
+    rec={"path":book.path,"opf":book.opf_path,"series":val,"index":index,"digest":hashlib.sha1(book.opf_data).hexdigest(),"new":new}
+    if keep: rec["book"]=book
+    else: book.close()
+    return rec
+def commit_plan_entry(rec,backup=True,backup_dir=None,backup_base=None,in_place=False,cache=None,store=None,journal=None):
+    # 重新打开书，OPF 与规划时一致才写回计划中的内容
+    path=rec["path"]
+    recover_inplace(path)
+    book=EpubBook(path,writable=in_place)
+    try:
+        opf,data=book.read_opf()
+        digest=hashlib.sha1(data).hexdigest()
+    except BaseException as e:
+        book.close(); _emit_timing(path,book.stats,error=e); raise
+    if opf!=rec["opf"] or digest!=rec["digest"]:
+        # 重复提交同一计划时，已写入的书不算作改动
+        res=f"跳过(已提交): {path}" if opf==rec["opf"] and digest==hashlib.sha1(rec["new"]).hexdigest() else f"跳过(规划后已变化): {path}"
+        book.close(); _emit_timing(path,book.stats,res); return res
+    return commit_file((book,rec["series"],rec["new"]),backup,backup_dir,backup_base,in_place,cache,store,journal)
+def write_plan_record(out,rec,base):
+    # 计划文件为 JSON Lines，新 OPF 以 base64 保存（保持原编码）；路径尽量写成相对计划文件所在目录，便于在存储主机上执行
+    try:
+        p=os.path.relpath(os.path.abspath(rec["path"]),base)
+    except ValueError:
+        p=os.path.abspath(rec["path"])
+    out.write(json.dumps({**rec,"path":p,"new":base64.b64encode(rec["new"]).decode("ascii")},ensure_ascii=False)+"\n")
+def read_plan(path):
+    # 流式读取计划文件；相对路径以计划文件所在目录为基准
+    base=os.path.dirname(os.path.abspath(path))
+    with open(path,encoding="utf-8") as f:
+        for n,line in enumerate(f,1):
+            if not line.strip(): continue
+            try:
+                r=json.loads(line)
+                r["new"]=base64.b64decode(r["new"],validate=True)
+                if not all(isinstance(r.get(k),str) and r[k] for k in ("path","opf","series","digest")): raise ValueError
+            except (ValueError,KeyError,TypeError):
+                raise ValueError(f"第{n}行不是有效的计划记录")
+            r["path"]=os.path.join(base,r["path"])
+            yield r
+class PlanCommitter:
+    # 后台提交：规划好的书按批交给单个写回线程，批内按 io_order 排序；
+    # 结果暂存，由调用方在不等待输入时取出打印，避免与提问交错
+    def __init__(self,backup=True,backup_dir=None,backup_base=None,in_place=False,cache=None,store=None,journal=None):
+        self.args=(backup,backup_dir,backup_base,in_place,cache,store,journal)
+        self.ex=ThreadPoolExecutor(max_workers=1,thread_name_prefix="escommit")
+        self.pending=collections.deque()
+    def submit(self,plans):
+        if plans: self.pending.append(self.ex.submit(self._run,sorted(plans,key=lambda r: io_order(r["path"]))))
+    def _run(self,plans):
+        out=[]
+        for rec in plans:
+            book=rec.pop("book",None)
+            try:
+                # 规划时的会话仍有效时直接写回；文件在此期间变化（或会话已关闭）才重新打开并核对摘要
+                if book is not None and book.unchanged():
+                    res=commit_file((book,rec["series"],rec["new"]),*self.args)
+                else:
+                    if book is not None: book.close()
+                    res=commit_plan_entry(rec,*self.args)
+                out.append((rec["path"],res,None))
+            except Exception as e:
+                out.append((rec["path"],None,e))
+        return out
+    def results(self,wait=False):
+        # 产出已完成批次的 (路径, 结果, 异常)；wait=True 时等待全部完成
+        while self.pending and (wait or self.pending[0].done()):
+            yield from self.pending.popleft().result()
+    def close(self):
+        self.ex.shutdown()
+EXPORT_FIELDS=("path","opf","collection","calibre","position","calibre_index","size","error")
+def scan_book(path,cache=None):
+    # 只读扫描：仅读取中央目录与 OPF 条目，返回一行导出记录；解析失败记录在 error 中
+    row=dict.fromkeys(EXPORT_FIELDS); row["path"]=path
+    try:
+        st=os.stat(path); row["size"]=st.st_size
+        rec=cache.lookup(path,st) if cache is not None else None
+        if rec is None:
+            with EpubBook(path) as book:
+                opf,data=book.read_opf()
+            rec=get_series_state(parse_opf_metadata(data)); rec["opf"]=opf
+            if cache is not None:
+                cache.store(path,st,opf,rec,hashlib.sha1(data).hexdigest())
+        for k in ("opf","collection","calibre","position","calibre_index"): row[k]=rec[k]
+    except Exception as e:
+        row["error"]=f"{type(e).__name__}: {e}"
+    return row
+def export_series(files,out,fmt="jsonl",jobs=1,cache=None):
+    # 并发扫描并按遍历顺序流式写出 JSONL 或 CSV；返回 (总数, 出错数)
+    n=bad=0
+    w=None
+    if fmt=="csv":
+        w=csv.DictWriter(out,fieldnames=EXPORT_FIELDS); w.writeheader()
+    for _,row,_ in run_batch(files,lambda f: scan_book(f,cache),jobs):
+        n+=1; bad+=row["error"] is not None
+        if w: w.writerow(row)
+        else: out.write(json.dumps(row,ensure_ascii=False)+"\n")
+    return n,bad
+# 清单中的标签类型：与交互模式的 1/2/3 对应，留空则沿用命令行参数
+MANIFEST_TAGS={"":None,"1":(True,False),"collection":(True,False),"epub3":(True,False),
+               "2":(False,True),"calibre":(False,True),"3":(True,True),"both":(True,True)}
+MANIFEST_CHUNK=10000
+def read_manifest(path):
+    # 流式读取清单：.jsonl/.ndjson 为每行一个 JSON 对象，其余按带表头的 CSV（path,series,index,tags）；相对路径以清单所在目录为基准
+    base=os.path.dirname(os.path.abspath(path))
+    with open(path,encoding="utf-8-sig",newline="") as f:
+        if path.lower().endswith((".jsonl",".ndjson")):
+            rows=(json.loads(line) for line in f if line.strip())
+        else:
+            rows=csv.DictReader(f)
+        for n,r in enumerate(rows,1):
+            if not isinstance(r,dict): raise ValueError(f"第{n}条记录不是对象")
+            p=str(r.get("path") or "").strip()
+            if not p: raise ValueError(f"第{n}条记录缺少 path")
+            idx=r.get("index")
+            try:
+                idx=None if idx in (None,"") else float(idx)
+            except (TypeError,ValueError):
+                raise ValueError(f"第{n}条记录序号无效: {idx}") from None
+            tags=str(r.get("tags") or "").strip().lower()
+            if tags not in MANIFEST_TAGS: raise ValueError(f"第{n}条记录标签类型无效: {tags}")
+            yield {"path":os.path.normpath(os.path.join(base,p)),"series":str(r.get("series") or "").strip() or None,
+                   "index":idx,"tags":MANIFEST_TAGS[tags]}
+def io_order(path):
+    # 写回顺序：按 (设备, 文件夹, 文件名) 排序，使同一磁盘、同一文件夹的书连续处理，减少寻道
+    try:
+        dev=os.stat(path).st_dev
+    except OSError:
+        dev=-1
+    return dev,os.path.dirname(path),os.path.basename(path)
+def plan_manifest(rows,chunk=MANIFEST_CHUNK):
+    # 分块排序：每块内按 io_order 排序；同一本书只应用第一次出现的记录
+    # 已出现的路径记在临时 SQLite 数据库中（文件名为空时为磁盘上的临时库，关闭即删除），内存占用不随清单增长
+    seen=sqlite3.connect("",check_same_thread=False)
+    try:
+        seen.execute("CREATE TABLE seen(path TEXT PRIMARY KEY)")
+        rows=iter(rows)
+        for block in iter(lambda: list(itertools.islice(rows,chunk)),[]):
+            for r in sorted(block,key=lambda r: io_order(r["path"])):
+                if seen.execute("INSERT OR IGNORE INTO seen VALUES (?)",(os.path.normcase(r["path"]),)).rowcount==0: r["dup"]=True
+                yield r
+    finally:
+        seen.close()
+# 系列名归一化：全角/半角（NFKC）、大小写、常用繁体字、卷号后缀与标点空白不影响分组
+# 标准库没有繁简转换，这里只覆盖系列名中常见的字
+_T2S=str.maketrans(dict(zip(*(lambda p: (p[0::2],p[1::2]))("傳传說说記记國国門门東东書书劍剑龍龙鬥斗戰战與与們们會会來来時时個个這这後后開开無无學学關关長长見见實实現现間间對对點点話话語语讀读變变體体經经過过還还進进選选遊游運运動动歷历錄录線线風风雲云電电愛爱華华藝艺術术陽阳陰阴聖圣獸兽魚鱼鳥鸟馬马車车軍军師师黃黄紅红綠绿藍蓝銀银鐵铁夢梦靈灵異异俠侠傑杰偵侦殺杀滅灭島岛鄉乡樂乐節节嶺岭園园圖图團团寶宝將将尋寻導导層层屬属帶带歸归復复從从應应戀恋懸悬擊击擇择數数斷断於于晉晋曉晓條条極极樓楼機机權权歡欢殘残氣气沒没淚泪滿满漢汉潛潜濤涛為为烏乌爭争爾尔牆墙狀状獄狱獨独環环產产畫画當当盡尽盤盘眾众礦矿禮礼種种競竞筆笔築筑紀纪紙纸細细終终結结絕绝統统絲丝網网緣缘總总織织羅罗聲声聽听脫脱腦脑興兴舊旧莊庄萬万葉叶蓋盖蘭兰處处號号衛卫裝装襲袭規规視视親亲覺觉觀观討讨詩诗誌志誰谁課课調调謀谋謎谜證证識识譯译護护貓猫貝贝財财貨货貴贵買买賞赏賢贤質质趙赵跡迹躍跃輪轮輕轻轉转農农連连週周達达遠远適适遲迟遺遗邊边郵邮醫医釋释針针鋼钢錢钱錯错鏡镜鐘钟閃闪閣阁陣阵陳陈陸陆險险隊队際际隨随隱隐雙双雜杂離离難难雞鸡靜静頁页頂顶項项順顺須须頭头題题顏颜願愿類类顯显飛飞飯饭養养餘余館馆驚惊驗验髮发魯鲁鳳凤鶴鹤麗丽麥麦黨党齊齐齒齿龜龟"))))
+_NUM=r'[\d一二三四五六七八九十百千零〇两]+'
+_VOL_SUFFIX_RE=re.compile(r'[\s\-_:：,，.·]*[(\[（【]?\s*(?:(?:vol(?:ume)?|book|part|tome|no)\.?\s*#?\s*(?:\d+|[ivxlc]+)|#\s*\d+|第\s*'+_NUM+r'\s*[卷册部集话篇辑季]|[卷册]\s*'+_NUM+r')\s*[)\]）】]?\s*$',re.IGNORECASE)
+# 末尾独立的罗马数字（续作编号）转为阿拉伯数字，聚类时与其他数字一样不合并
+_ROMAN={"i":1,"ii":2,"iii":3,"iv":4,"v":5,"vi":6,"vii":7,"viii":8,"ix":9,"x":10}
+_ROMAN_RE=re.compile(r'(?:(?<=\s)|(?<=[^\x00-\x7f]))(viii|vii|iii|ix|iv|vi|ii|x|v|i)$')
+def normalize_series(name):
+    s=unicodedata.normalize("NFKC",name).translate(_T2S).casefold().strip()
+    prev=None
+    while prev!=s:
+        prev=s; s=_VOL_SUFFIX_RE.sub("",s)
+    s=_ROMAN_RE.sub(lambda m: str(_ROMAN[m.group(1)]),s)
+    return re.sub(r'[\W_]+','',s) or s
+def cluster_series(keys,threshold=0.85,max_block=200):
+    # 近似重复聚类：以二元字组建立倒排索引分块，只比较共享足够多字组且长度相近的键，避免两两比较；
+    # 过于常见的字组不参与分块；数字不同的键（如续作 2、3）不合并。返回 {键: 所属簇的代表键}
+    keys=sorted(keys)
+    parent={k:k for k in keys}
+    def find(k):
+        while parent[k]!=k:
+            parent[k]=parent[parent[k]]; k=parent[k]
+        return k
+    grams={k:{k[i:i+2] for i in range(max(1,len(k)-1))} for k in keys}
+    index=collections.defaultdict(list)
+    for k in keys:
+        for g in grams[k]: index[g].append(k)
+    for k in keys:
+        cand=collections.Counter()
+        for g in grams[k]:
+            post=index[g]
+            if len(post)<=max_block: cand.update(post)
+        for o,shared in cand.items():
+            if o<=k or shared*2<min(len(grams[k]),len(grams[o])): continue
+            if min(len(k),len(o))<threshold*max(len(k),len(o)): continue
+            if re.findall(r'\d+',k)!=re.findall(r'\d+',o): continue
+            if difflib.SequenceMatcher(None,k,o,autojunk=False).ratio()>=threshold:
+                a,b=find(k),find(o)
+                if a!=b: parent[max(a,b)]=min(a,b)
+    return {k:find(k) for k in keys}
+def _is_number(v):
+    try:
+        return math.isfinite(float(v))
+    except (TypeError,ValueError):
+        return False
+def consolidate_series(files,out,fmt="jsonl",jobs=1,cache=None,threshold=0.85):
+    # 扫描一次全库：每本的系列写入临时文件，内存中只保留各系列名的计数；聚类后为每个簇选出书最多的写法作为统一名称，
+    # 再读一遍临时文件，为写法不同的书输出清单（字段同 --manifest，保留原序号与标签类型）。返回 ([(统一名, {写法: 本数})], 输出行数)
+    counts=collections.defaultdict(collections.Counter)
+    n=0
+    with tempfile.TemporaryFile("w+",encoding="utf-8") as spool:
+        for _,row,_ in run_batch(files,lambda f: scan_book(f,cache),jobs):
+            names=[v for v in (row["collection"],row["calibre"]) if v]
+            if row["error"] or not names: continue
+            for v in set(names): counts[normalize_series(v)][v]+=1
+            spool.write(json.dumps([row["path"],row["collection"],row["calibre"],row["position"],row["calibre_index"]],ensure_ascii=False)+"\n")
+        roots=cluster_series(counts,threshold)
+        clusters=collections.defaultdict(collections.Counter)
+        for k,c in counts.items(): clusters[roots[k]].update(c)
+        canon={r:min(c.items(),key=lambda kv:(-kv[1],kv[0]))[0] for r,c in clusters.items()}
+        w=None
+        if fmt=="csv":
+            w=csv.DictWriter(out,fieldnames=("path","series","index","tags")); w.writeheader()
+        spool.seek(0)
+        for line in spool:
+            path,col,cal,pos,cidx=json.loads(line)
+            # 每种标签按各自所在的簇统一，只输出写法与统一名称不同的标签
+            fix={}
+            for tag,v in (("collection",col),("calibre",cal)):
+                if v and canon[roots[normalize_series(v)]]!=v: fix[tag]=canon[roots[normalize_series(v)]]
+            if not fix: continue
+            # 序号沿用对应标签的原序号，只保留数值（非数值的序号会使清单无法读取）
+            idx={t:(v if _is_number(v) else "") for t,v in (("collection",pos),("calibre",cidx))}
+            # 清单每本只能有一行：两种标签的统一名称或序号不同时先统一 collection，再次合并时输出 calibre
+            if len(fix)==2 and (fix["collection"]!=fix["calibre"] or len({v and float(v) for v in idx.values()})>1): del fix["calibre"]
+            tags="both" if len(fix)==2 else next(iter(fix))
+            t=tags if tags!="both" else "collection"
+            rec={"path":os.path.abspath(path),"series":fix[t],"index":idx[t],"tags":tags}
+            if w: w.writerow(rec)
+            else: out.write(json.dumps(rec,ensure_ascii=False)+"\n")
+            n+=1
+    merged=[(canon[r],dict(c)) for r,c in clusters.items() if len(c)>1]
+    return sorted(merged),n
+# 自动序号的排序方式：name 为遍历顺序（按名称），natural 为数字按数值比较，volume 为从文件名解析的卷号，
+# date 为 OPF 的 dc:date，position 为已有的 group-position（或 calibre:series_index）；取不到的排在最后并按自然顺序
+ORDER_STRATEGIES=("name","natural","volume","date","position")
+def natural_key(name):
+    # 文本与数字交替的元组：数字按数值比较，"Vol 2" 排在 "Vol 10" 之前
+    parts=re.split(r'(\d+)',unicodedata.normalize("NFKC",name).casefold())
+    return tuple(int(p) if i%2 else p for i,p in enumerate(parts))
+_CN_DIGIT={c:i for i,c in enumerate("零一二三四五六七八九")}; _CN_DIGIT.update({"〇":0,"两":2})
+_CN_UNIT={"十":10,"百":100,"千":1000}
+def cn_number(s):
+    # 阿拉伯数字或中文数字（十二、二十、一百零五、一二三）
+    if s.isdigit(): return int(s)
+    if not any(c in _CN_UNIT for c in s):
+        return int("".join(str(_CN_DIGIT[c]) for c in s))
+    total=num=0
+    for c in s:
+        if c in _CN_UNIT:
+            total+=(num or 1)*_CN_UNIT[c]; num=0
+        else:
+            num=_CN_DIGIT[c]
+    return total+num
+def roman_number(s):
+    vals={"i":1,"v":5,"x":10,"l":50,"c":100}
+    n=[vals[c] for c in s.lower()]
+    return sum(-v if i+1<len(n) and v<n[i+1] else v for i,v in enumerate(n))
+_ROMAN_NUM=r'(?=[ivxlc])(?:xc|xl|l?x{0,3})(?:ix|iv|v?i{0,3})'
+_VOLUME_RES=(
+    re.compile(r'第\s*('+_NUM+r')\s*[卷册部集话篇辑季]'),
+    re.compile(r'[卷册]\s*('+_NUM+r')'),
+    re.compile(r'(?:vol(?:ume)?|book|part|tome|no)\.?\s*#?\s*(\d+|'+_ROMAN_NUM+r')\b',re.IGNORECASE),
+    re.compile(r'#\s*(\d+)'),
+    re.compile(r'(?:(?<=[\s_\-])|(?<=[^\x00-\x7f]))('+_ROMAN_NUM+r')$',re.IGNORECASE),
+    re.compile(r'(\d+)(?!.*\d)'),
+)
+def volume_number(name):
+    # 从文件名（不含扩展名）解析卷号：第N卷/卷N/Vol.N/#N，末尾的罗马数字（如“狼与辛香料 I”），最后退回到最后一个数字
+    stem=unicodedata.normalize("NFKC",os.path.splitext(os.path.basename(name))[0]).strip()
+    for r in _VOLUME_RES:
+        m=r.search(stem)
+        if not m: continue
+        v=m.group(1)
+        if not v: continue
+        try:
+            return cn_number(v) if not v.isascii() or v.isdigit() else roman_number(v)
+        except KeyError:
+            continue
+    return None
+def book_date(meta):
+    # dc:date：优先出版日期（无 opf:event 或 event=publication），取不到时返回 None
+    dates=[e for e in meta if e.tag.endswith("}date") and (e.text or "").strip()]
+    for e in dates:
+        ev=next((v for k,v in e.attrib.items() if k.endswith("event")),"publication")
+        if ev.lower()=="publication": return e.text.strip()
+    return dates[0].text.strip() if dates else None
+def order_key(path,order,cache=None):
+    # 每本书只计算一次的排序键：(0, 主键, 文件名的自然顺序)；取不到主键时为 (1, 0, 自然顺序)，
+    # 与读取出错的书同形，不同类型的主键不会互相比较
+    nk=natural_key(os.path.basename(path))
+    if order=="natural": return (0,0,nk)
+    if order=="volume":
+        v=volume_number(path)
+        return (1,0,nk) if v is None else (0,v,nk)
+    if order=="position":
+        row=scan_book(path,cache)
+        v=row["position"] or row["calibre_index"]
+        try:
+            return (0,float(v),nk)
+        except (TypeError,ValueError):
+            return (1,0,nk)
+    with EpubBook(path) as book:
+        d=book_date(parse_opf_metadata(book.read_opf()[1]))
+    return (1,0,nk) if d is None else (0,d,nk)
+def order_files(files,order="name",jobs=1,cache=None):
+    # 按文件夹分组排序（遍历时同一文件夹的书是连续产出的），文件夹之间保持遍历顺序；读取元数据可并发
+    if order=="name":
+        yield from files; return
+    for _,group in itertools.groupby(files,key=os.path.dirname):
+        keyed=[]
+        for f,k,e in run_batch(list(group),lambda f: order_key(f,order,cache),jobs):
+            keyed.append((k if e is None else (1,0,natural_key(os.path.basename(f))),f))
+        keyed.sort()
+        for _,f in keyed: yield f
+class RunJournal:
+    # 批处理日志（追加写 JSON Lines）：每本书的计划写入（plan）、提交（commit，含备份位置）与跳过（skip）
+    # 按条数或时间间隔批量 fsync；中断时最多丢失最后一批记录，续跑时这些书会被重新处理
+    SYNC_EVERY=256
+    SYNC_INTERVAL=5.0
+    def __init__(self,path,readonly=False):
+        # readonly=True 只读取已完成的记录（预览或保存计划时续跑），不写入日志
+        self.path=path; self.lock=threading.Lock()
+        self.done={}; self.planned=set()
+        tail=b"\n"
+        if os.path.exists(path):
+            with open(path,"rb") as f:
+                for line in f:
+                    tail=line[-1:]
+                    try:
+                        r=json.loads(line)
+                    except ValueError:
+                        # 中断时可能留下不完整的最后一行
+                        continue
+                    if r.get("ev")=="plan": self.planned.add(r["path"])
+                    elif r.get("ev") in ("commit","skip"):
+                        self.planned.discard(r["path"]); self.done[r["path"]]=(r.get("size"),r.get("mtime_ns"))
+        self.f=None
+        if readonly: return
+        self.f=open(path,"a",encoding="utf-8")
+        if tail!=b"\n": self.f.write("\n")
+        self.pending=0; self.last=time.monotonic()
+    def finished(self,path):
+        # 已提交或已跳过，且之后文件未再变化
+        rec=self.done.get(os.path.abspath(path))
+        if rec is None: return False
+        try:
+            st=os.stat(path)
+        except OSError:
+            return False
+        return rec==(st.st_size,st.st_mtime_ns)
+    def log(self,ev,path,**kw):
+        rec={"ev":ev,"path":os.path.abspath(path),"t":round(time.time(),3)}
+        if ev!="plan":
+            st=os.stat(path); rec["size"]=st.st_size; rec["mtime_ns"]=st.st_mtime_ns
+        rec.update(kw)
+        line=json.dumps(rec,ensure_ascii=False)+"\n"
+        with self.lock:
+            self.f.write(line); self.pending+=1
+            if self.pending>=self.SYNC_EVERY or time.monotonic()-self.last>=self.SYNC_INTERVAL: self._sync()
+    def _sync(self):
+        self.f.flush(); os.fsync(self.f.fileno())
+        self.pending=0; self.last=time.monotonic()
+    def close(self):
+        if self.f is None: return
+        with self.lock:
+            self._sync(); self.f.close()
+def run_batch(items,fn,jobs=1):
+    # 按输入顺序逐个产出 (item, 结果, 异常)；jobs>1 时用线程池并发执行，最多预先提交 jobs*4 个
+    if jobs<=1:
+        for it in items:
+            try:
+                yield it, fn(it), None
+            except Exception as e:
+                yield it, None, e
+        return
+    def call(it):
+        try:
+            return fn(it), None
+        except Exception as e:
+            return None, e
+    with ThreadPoolExecutor(max_workers=jobs) as ex:
+        pending=collections.deque()
+        for it in items:
+            pending.append((it, ex.submit(call, it)))
+            if len(pending)>=jobs*4:
+                it0, fut=pending.popleft()
+                yield (it0,)+fut.result()
+        while pending:
+            it0, fut=pending.popleft()
+            yield (it0,)+fut.result()
+def run_batch_async(items,steps,inflight=16,key=None):
+    # 异步调度：steps 为 [(函数, 类型)]，函数以 (item, 上一步结果) 调用，类型 io=读取、cpu=编辑、write=写回；某步返回字符串即视为完成
+    # 同时进行的 I/O 操作不超过 inflight 个；key(item) 相同（同一文件夹）的写回按输入顺序进行；结果仍按输入顺序产出
+    loop=asyncio.new_event_loop()
+    io=ThreadPoolExecutor(max_workers=inflight,thread_name_prefix="esio")
+    cpu=ThreadPoolExecutor(max_workers=1,thread_name_prefix="esedit")
+    sem=asyncio.Semaphore(inflight)
+    tails={}
+    async def one(item,prev,done):
+        try:
+            value=item
+            for fn,kind in steps:
+                if kind=="write" and prev is not None:
+                    await prev
+                if kind=="cpu":
+                    value=await loop.run_in_executor(cpu,fn,item,value)
+                else:
+                    async with sem:
+                        value=await loop.run_in_executor(io,fn,item,value)
+                if isinstance(value,str): return value,None
+            return value,None
+        except Exception as e:
+            return None,e
+        finally:
+            done.set_result(None)
+    def submit(it):
+        k=key(it) if key else None
+        done=loop.create_future()
+        prev=tails.get(k) if key else None
+        if key: tails[k]=done
+        return loop.create_task(one(it,prev,done))
+    try:
+        pending=collections.deque()
+        for it in items:
+            pending.append((it,submit(it)))
+            if len(pending)>=inflight*4:
+                it0,task=pending.popleft()
+                yield (it0,)+loop.run_until_complete(task)
+        while pending:
+            it0,task=pending.popleft()
+            yield (it0,)+loop.run_until_complete(task)
+    finally:
+        for _,task in pending: task.cancel()
+        io.shutdown(wait=True); cpu.shutdown(wait=True)
+        loop.close()
 def find_epubs(p,rec=False):
+    # 惰性遍历：每个文件夹内按名称排序，先产出本文件夹的书再进入子文件夹，首个文件夹即可开始处理
+    # 跳过隐藏项与 .bak/.tmp；符号链接目录按真实路径去重，避免循环
     p=pathlib.Path(p)
-    if p.is_file() and p.suffix.lower()==".epub": return [str(p)]
-    glob="**/*.epub" if rec else "*.epub"
-    return [str(x) for x in p.glob(glob)]
+    if p.is_file():
+        if p.suffix.lower()==".epub": yield str(p)
+        return
+    root=str(p)
+    seen={os.path.realpath(root)}
+    stack=[root]
+    while stack:
+        d=stack.pop()
+        try:
+            with os.scandir(d) as it:
+                entries=sorted(it,key=lambda e: e.name)
+        except OSError:
+            continue
+        subdirs=[]
+        for e in entries:
+            name=e.name
+            if name.startswith(".") or name.lower().endswith((".bak",".tmp")): continue
+            path=name if d=="." else os.path.join(d,name)
+            try:
+                if e.is_dir():
+                    if not rec: continue
+                    if e.is_symlink():
+                        real=os.path.realpath(path)
+                        if real in seen: continue
+                        seen.add(real)
+                    subdirs.append(path)
+                elif name.lower().endswith(".epub") and e.is_file():
+                    yield path
+            except OSError:
+                continue
+        stack.extend(reversed(subdirs))
+class _Inotify:
+    # Linux inotify（通过 ctypes 调用 libc）：监视文件夹内写完关闭、移入的文件与新建的子文件夹
+    IN_CLOSE_WRITE=0x8; IN_MOVED_TO=0x80; IN_CREATE=0x100; IN_Q_OVERFLOW=0x4000; IN_IGNORED=0x8000; IN_ISDIR=0x40000000
+    MASK=IN_CLOSE_WRITE|IN_MOVED_TO|IN_CREATE
+    _EVENT=struct.Struct("iIII")
+    def __init__(self):
+        import ctypes,ctypes.util
+        libc=ctypes.CDLL(ctypes.util.find_library("c") or None,use_errno=True)
+        if not hasattr(libc,"inotify_init1"): raise OSError("inotify 不可用")
+        self._ctypes=ctypes; self._libc=libc
+        self.fd=libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd<0: raise OSError(ctypes.get_errno(),"inotify_init1 失败")
+        self.dirs={}
+    def add(self,path):
+        wd=self._libc.inotify_add_watch(self.fd,os.fsencode(path),self.MASK)
+        if wd<0: raise OSError(self._ctypes.get_errno(),f"无法监视: {path}")
+        self.dirs[wd]=path
+    def read(self,timeout=None):
+        # 返回 [(路径, 是否文件夹)]；事件队列溢出时返回 None，调用方需重新扫描
+        import select
+        if not select.select([self.fd],[],[],timeout)[0]: return []
+        buf=os.read(self.fd,1<<16); out=[]; i=0
+        while i+self._EVENT.size<=len(buf):
+            wd,mask,_,n=self._EVENT.unpack_from(buf,i)
+            name=buf[i+self._EVENT.size:i+self._EVENT.size+n].rstrip(b"\0")
+            i+=self._EVENT.size+n
+            if mask & self.IN_Q_OVERFLOW: return None
+            if mask & self.IN_IGNORED: self.dirs.pop(wd,None); continue
+            if wd in self.dirs and name:
+                out.append((os.path.join(self.dirs[wd],os.fsdecode(name)),bool(mask & self.IN_ISDIR)))
+        return out
+    def close(self):
+        os.close(self.fd)
+def watch_epubs(root,rec=False,settle=5.0,interval=10.0,poll=False,maxsize=256,done=None):
+    # 监视新增或变化的 EPUB：文件在 settle 秒内大小与修改时间不再变化才视为复制完成，放入有界队列后逐个产出
+    # 队列满时监视线程阻塞等待（背压）；inotify 不可用（或 poll=True，如 NFS/SMB）时每 interval 秒扫描一次
+    # done 为 {路径: (大小, mtime_ns)}，记录本程序刚写回的结果，避免自身的写回再次触发
+    done={} if done is None else done
+    q=queue.Queue(maxsize)
+    ino=None
+    if not poll and os.path.isdir(root):
+        try:
+            ino=_Inotify()
+        except OSError:
+            ino=None
+    def stat_of(path):
+        try:
+            st=os.stat(path); return st.st_size,st.st_mtime_ns
+        except OSError:
+            return None
+    def walk_dirs(d):
+        yield d
+        if not rec: return
+        for cur,subs,_ in os.walk(d):
+            subs[:]=[x for x in subs if not x.startswith(".")]
+            for x in subs: yield os.path.join(cur,x)
+    def snapshot():
+        return {f:stat_of(f) for f in find_epubs(root,rec)}
+    def run():
+        try:
+            loop()
+        except BaseException as e:
+            # 交给消费端抛出，避免生成器永远等待
+            q.put(e)
+    def loop():
+        nonlocal ino
+        pending={}
+        known=None
+        def note(path):
+            name=os.path.basename(path)
+            if name.startswith(".") or not name.lower().endswith(".epub"): return
+            st=stat_of(path)
+            if st is None or done.get(path)==st: return
+            pending[path]=(time.monotonic(),st)
+        def watch(path):
+            # 加入监视时已被移走的文件夹直接跳过；监视数用尽（ENOSPC）或无权限时改为定时扫描
+            nonlocal ino,known
+            for d in walk_dirs(path):
+                try:
+                    ino.add(d)
+                except OSError as e:
+                    if e.errno in (errno.ENOENT,errno.ENOTDIR): continue
+                    if e.errno not in (errno.ENOSPC,errno.EACCES,errno.EPERM): raise
+                    print(f"提示: {e}，改为每 {interval} 秒扫描一次",file=sys.stderr)
+                    ino.close(); ino=None; known=snapshot()
+                    return False
+            return True
+        if ino is not None:
+            watch(root)
+        if known is None and ino is None:
+            known=snapshot()
+        while True:
+            timeout=settle/2 if pending else (None if ino is not None else interval)
+            if ino is not None:
+                events=ino.read(timeout)
+                if events is None:
+                    # 事件溢出：补扫一遍，交给去抖与 done 过滤
+                    for f in find_epubs(root,rec): note(f)
+                    events=[]
+                for path,is_dir in events:
+                    if is_dir:
+                        if not rec or os.path.basename(path).startswith("."): continue
+                        # 新文件夹可能在加入监视前已有文件
+                        ok=watch(path)
+                        for f in find_epubs(path,True): note(f)
+                        if not ok: break
+                    else:
+                        note(path)
+            else:
+                time.sleep(timeout)
+                cur=snapshot()
+                for f,st in cur.items():
+                    if known.get(f)!=st: note(f)
+                known=cur
+            now=time.monotonic()
+            for path,(t,st) in list(pending.items()):
+                cur=stat_of(path)
+                if cur is None:
+                    del pending[path]
+                elif cur!=st:
+                    pending[path]=(now,cur)
+                elif now-t>=settle:
+                    del pending[path]
+                    # 事件可能在写回完成、done 更新之前到达，出队前再核对一次
+                    if done.get(path)!=cur: q.put(path)
+    threading.Thread(target=run,name="esewatch",daemon=True).start()
+    while True:
+        item=q.get()
+        if isinstance(item,BaseException): raise item
+        yield item
+def _peek(it):
+    # 取出第一个元素判断是否为空，并返回可继续迭代的完整序列
+    it=iter(it)
+    first=next(it,None)
+    return None if first is None else itertools.chain([first],it)
 
 def ask_yn(prompt, default=False):
     try:
@@ -134,193 +1436,208 @@ def ask_choice(prompt, choices, default):
     return s
 
 # 交互：按当前文件顺序分配/调整系列序号
-# 命令：
+# 全屏界面（Windows 控制台或 curses）：↑/↓ 移动，PgUp/PgDn 翻页，Home/End 首尾，G 跳到位置，回车切换拖动/浏览，
+# S/N/A/C 序号操作，ESC 完成；只绘制可见的行，且只重绘内容变化的行，上千本的文件夹也能即时响应
+# 命令行回退界面的命令：
 #  - m i pos   将第 i 项移动到位置 pos
 #  - s i j     交换第 i 与第 j 项
 #  - set i N   将第 i 项的序号设为 N（支持整数或小数）
 #  - start N   设置起始序号并按当前排序重新编号
 #  - auto      按当前排序从起始序号自动连续编号
+#  - l pos     列出 pos 附近的一页
 #  - done      完成并继续
 #  - help      显示帮助与当前列表
 
+def _num(v):
+    return float(v) if "." in v else int(v)
+def _width(ch):
+    # 显示宽度：中日韩全角字符占两列
+    return 2 if unicodedata.east_asian_width(ch) in "WF" else 1
+def _clip(s, width):
+    n = 0
+    for i, ch in enumerate(s):
+        n += _width(ch)
+        if n > width: return s[:i]
+    return s
+class OrderList:
+    # 排序数据：文件、文件名与序号分列存放在并列的列表中；逐行拖动为 O(1) 交换，跳到任意位置为一次列表移位
+    def __init__(self, flist, start=1):
+        self.files = list(flist)
+        self.names = [pathlib.Path(f).name for f in self.files]
+        self.start = start
+        self.idx = list(range(start, start+len(self.files)))
+        self.cursor = 0; self.top = 0; self.dragging = False
+    def __len__(self):
+        return len(self.files)
+    def move(self, i, j):
+        # 第 i 项移到位置 j，中间各项顺移；序号随书移动
+        if i == j: return
+        cols = (self.files, self.names, self.idx)
+        if abs(i-j) == 1:
+            for a in cols: a[i], a[j] = a[j], a[i]
+        else:
+            for a in cols: a.insert(j, a.pop(i))
+    def swap(self, i, j):
+        for a in (self.files, self.names, self.idx): a[i], a[j] = a[j], a[i]
+    def go(self, pos):
+        # 移动光标；拖动模式下当前项随光标移动
+        pos = max(0, min(len(self)-1, pos))
+        if self.dragging: self.move(self.cursor, pos)
+        self.cursor = pos
+    def scroll(self, height):
+        # 让光标保持在视口内
+        if self.cursor < self.top: self.top = self.cursor
+        elif self.cursor >= self.top+height: self.top = self.cursor-height+1
+        self.top = max(0, min(self.top, len(self)-height))
+    def renumber(self, i=0):
+        # i=0 从起始序号连续编号；否则从第 i 项当前序号起向后连续编号（小数向上取整）
+        if i == 0:
+            cur = self.start
+        else:
+            cur0 = self.idx[i-1]
+            cur = math.ceil(cur0) if isinstance(cur0, float) and not float(cur0).is_integer() else cur0+1
+        for j in range(i, len(self)):
+            self.idx[j] = cur; cur = cur+1
+    def row(self, pos):
+        prefix = ">" if pos == self.cursor else " "
+        return f"{prefix} {pos+1:>{len(str(len(self)))}}. [{self.idx[pos]}] {self.names[pos]}"
+    def result(self):
+        return list(self.files), dict(zip(self.files, self.idx))
+
+class _ConsoleTerm:
+    # Windows 控制台：msvcrt 读键，VT 转义序列定位到行并清除行尾
+    KEYS = {72:"up", 80:"down", 73:"pgup", 81:"pgdn", 71:"home", 79:"end"}
+    def __init__(self):
+        import msvcrt
+        self.msvcrt = msvcrt
+        os.system("")  # 打开控制台的 VT 转义序列支持
+    def size(self):
+        s = shutil.get_terminal_size()
+        return s.lines, s.columns
+    def clear(self):
+        sys.stdout.write("\x1b[2J")
+    def put(self, y, text):
+        sys.stdout.write(f"\x1b[{y+1};1H{text}\x1b[K")
+    def flush(self):
+        sys.stdout.flush()
+    def key(self):
+        ch = self.msvcrt.getwch()
+        if ch in ("\x00", "\xe0"):
+            return self.KEYS.get(ord(self.msvcrt.getwch()))
+        return {"\x1b":"esc", "\r":"enter", "\n":"enter"}.get(ch, ch.lower())
+    def prompt(self, label):
+        h, _ = self.size()
+        sys.stdout.write(f"\x1b[{h};1H\x1b[K"); sys.stdout.flush()
+        return input(label).strip()
+
+class _CursesTerm:
+    def __init__(self, stdscr):
+        import curses
+        self.curses = curses; self.scr = stdscr
+        self.keys = {curses.KEY_UP:"up", curses.KEY_DOWN:"down", curses.KEY_PPAGE:"pgup", curses.KEY_NPAGE:"pgdn",
+                     curses.KEY_HOME:"home", curses.KEY_END:"end", curses.KEY_RESIZE:"resize", 27:"esc", 10:"enter", 13:"enter"}
+        curses.curs_set(0); stdscr.keypad(True)
+    def size(self):
+        return self.scr.getmaxyx()
+    def clear(self):
+        self.scr.clear()
+    def put(self, y, text):
+        self.scr.move(y, 0); self.scr.clrtoeol()
+        self.scr.addstr(y, 0, text)
+    def flush(self):
+        self.scr.refresh()
+    def key(self):
+        ch = self.scr.getch()
+        if ch in self.keys: return self.keys[ch]
+        return chr(ch).lower() if 0 <= ch < 0x110000 else None
+    def prompt(self, label):
+        h, _ = self.size()
+        c = self.curses
+        self.put(h-1, label); c.echo(); c.curs_set(1)
+        try:
+            return self.scr.getstr(h-1, sum(map(_width, label))).decode("utf-8", "replace").strip()
+        finally:
+            c.noecho(); c.curs_set(0)
+
+def _order_screen(ol, term):
+    # 视口渲染：第 0、1 行为标题与状态，最后一行留给输入提示；只重绘与上次内容不同的行
+    shown = {}
+    last = None
+    def body():
+        return max(1, term.size()[0]-3)
+    def paint():
+        nonlocal last
+        h, w = term.size()
+        if (h, w) != last:
+            term.clear(); shown.clear(); last = (h, w)
+        ol.scroll(body())
+        lines = ["交互排序：↑/↓ 移动，PgUp/PgDn 翻页，Home/End 首尾，G 跳到位置，回车切换拖动/浏览，S/N/A/C 序号操作，ESC 完成",
+                 f"模式：{'拖动' if ol.dragging else '浏览'}，起始序号：{ol.start}，位置：{ol.cursor+1}/{len(ol)}"]
+        lines += [ol.row(p) for p in range(ol.top, min(len(ol), ol.top+body()))]
+        lines += [""]*(h-1-len(lines))
+        for y, text in enumerate(lines[:h-1]):
+            text = _clip(text, w-1)
+            if shown.get(y) != text:
+                term.put(y, text); shown[y] = text
+        term.flush()
+    paint()
+    while True:
+        k = term.key()
+        if k == "esc":
+            break
+        if k == "enter":
+            ol.dragging = not ol.dragging
+        elif k == "up": ol.go(ol.cursor-1)
+        elif k == "down": ol.go(ol.cursor+1)
+        elif k == "pgup": ol.go(ol.cursor-body())
+        elif k == "pgdn": ol.go(ol.cursor+body())
+        elif k == "home": ol.go(0)
+        elif k == "end": ol.go(len(ol)-1)
+        elif k == "resize": last = None
+        elif k in ("g", "s", "n"):
+            label = {"g":"跳到位置: ", "s":"起始序号: ", "n":"当前项序号: "}[k]
+            v = term.prompt(label)
+            try:
+                if k == "g": ol.go(int(v)-1)
+                elif k == "s": ol.start = _num(v)
+                else: ol.idx[ol.cursor] = _num(v)
+            except ValueError:
+                pass
+            # 输入可能使控制台滚动，整屏重绘
+            last = None
+        elif k == "a": ol.renumber()
+        elif k == "c": ol.renumber(ol.cursor+1)
+        else:
+            continue
+        paint()
+
 def interactive_order_indices(flist, start=1):
-    items = [{"file": f, "name": pathlib.Path(f).name, "idx": None} for f in flist]
     try:
         start = int(start)
     except Exception:
         start = 1
-    cur = start
-    for it in items:
-        it["idx"] = cur
-        cur += 1
+    ol = OrderList(flist, start)
+    if not ol:
+        return [], {}
     try:
-        import msvcrt, os
-        cursor = 0
-        dragging = False
-        def show():
-            try:
-                os.system("cls")
-            except Exception:
-                pass
-            print("交互排序：↑/↓ 移动，回车切换拖动/浏览，S/N/A/C 序号操作，ESC 完成")
-            print(f"模式：{'拖动' if dragging else '浏览'}，起始序号：{start}")
-            for pos, it in enumerate(items, 1):
-                prefix = ">" if pos-1 == cursor else " "
-                print(f"{prefix} {pos:>2}. [{it['idx']}] {it['name']}")
-        show()
-        while True:
-            ch = msvcrt.getwch()
-            if ch in ("\x1b",):
-                break
-            if ch in ("\r", "\n"):
-                dragging = not dragging
-                show()
-                continue
-            if ch in ("s","S"):
-                try:
-                    v = input("起始序号: ").strip()
-                    start = float(v) if "." in v else int(v)
-                except Exception:
-                    start = start
-                show()
-                continue
-            if ch in ("n","N"):
-                try:
-                    v = input("当前项序号: ").strip()
-                    items[cursor]["idx"] = float(v) if "." in v else int(v)
-                except Exception:
-                    pass
-                show()
-                continue
-            if ch in ("a","A"):
-                cur = start
-                for it in items:
-                    it["idx"] = cur
-                    cur = cur + 1
-                show()
-                continue
-            if ch in ("c","C"):
-                cur0 = items[cursor]["idx"]
-                cur = (math.ceil(cur0) if isinstance(cur0, float) and not float(cur0).is_integer() else (cur0 + 1))
-                items[cursor]["idx"] = cur0
-                for i in range(cursor + 1, len(items)):
-                    items[i]["idx"] = cur
-                    cur = cur + 1
-                show()
-                continue
-            if ch in ("\x00", "\xe0"):
-                code = ord(msvcrt.getwch())
-                if code == 72:
-                    if dragging and cursor > 0:
-                        it = items.pop(cursor)
-                        cursor -= 1
-                        items.insert(cursor, it)
-                        show()
-                    elif not dragging and cursor > 0:
-                        cursor -= 1
-                        show()
-                elif code == 80:
-                    if dragging and cursor < len(items)-1:
-                        it = items.pop(cursor)
-                        cursor += 1
-                        items.insert(cursor, it)
-                        show()
-                    elif not dragging and cursor < len(items)-1:
-                        cursor += 1
-                        show()
-                continue
-        order = [it["file"] for it in items]
-        idx_map = {it["file"]: it["idx"] for it in items}
-        return order, idx_map
+        _order_screen(ol, _ConsoleTerm())
+        return ol.result()
     except Exception:
         try:
             import curses
-            def run(stdscr):
-                curses.curs_set(0)
-                cursor = 0
-                dragging = False
-                def draw():
-                    stdscr.clear()
-                    stdscr.addstr(0, 0, f"交互排序：↑/↓ 移动，回车切换拖动/浏览，S/N/A/C 序号操作，ESC 完成")
-                    stdscr.addstr(1, 0, f"模式：{'拖动' if dragging else '浏览'}，起始序号：{start}")
-                    for pos, it in enumerate(items, 1):
-                        prefix = ">" if pos-1 == cursor else " "
-                        stdscr.addstr(1+pos, 0, f"{prefix} {pos:>2}. [{it['idx']}] {it['name']}")
-                    stdscr.refresh()
-                draw()
-                while True:
-                    ch = stdscr.getch()
-                    if ch == 27:
-                        break
-                    if ch in (10, 13):
-                        dragging = not dragging
-                        draw()
-                        continue
-                    if ch in (ord('s'), ord('S')):
-                        curses.echo()
-                        stdscr.addstr(len(items)+3, 0, "起始序号: ")
-                        v = stdscr.getstr(len(items)+3, 6+4).decode('utf-8').strip()
-                        curses.noecho()
-                        try:
-                            start = float(v) if "." in v else int(v)
-                        except Exception:
-                            pass
-                        draw()
-                        continue
-                    if ch in (ord('n'), ord('N')):
-                        curses.echo()
-                        stdscr.addstr(len(items)+3, 0, "当前项序号: ")
-                        v = stdscr.getstr(len(items)+3, 6+6).decode('utf-8').strip()
-                        curses.noecho()
-                        try:
-                            items[cursor]["idx"] = float(v) if "." in v else int(v)
-                        except Exception:
-                            pass
-                        draw()
-                        continue
-                    if ch in (ord('a'), ord('A')):
-                        cur = start
-                        for it in items:
-                            it["idx"] = cur
-                            cur = cur + 1
-                        draw()
-                        continue
-                    if ch in (ord('c'), ord('C')):
-                        cur0 = items[cursor]["idx"]
-                        cur = (math.ceil(cur0) if isinstance(cur0, float) and not float(cur0).is_integer() else (cur0 + 1))
-                        items[cursor]["idx"] = cur0
-                        for i in range(cursor + 1, len(items)):
-                            items[i]["idx"] = cur
-                            cur = cur + 1
-                        draw()
-                        continue
-                    if ch == curses.KEY_UP:
-                        if dragging and cursor > 0:
-                            it = items.pop(cursor)
-                            cursor -= 1
-                            items.insert(cursor, it)
-                            draw()
-                        elif not dragging and cursor > 0:
-                            cursor -= 1
-                            draw()
-                    elif ch == curses.KEY_DOWN:
-                        if dragging and cursor < len(items)-1:
-                            it = items.pop(cursor)
-                            cursor += 1
-                            items.insert(cursor, it)
-                            draw()
-                        elif not dragging and cursor < len(items)-1:
-                            cursor += 1
-                            draw()
-                return [it["file"] for it in items], {it["file"]: it["idx"] for it in items}
-            order, idx_map = curses.wrapper(run)
-            return order, idx_map
+            curses.wrapper(lambda stdscr: _order_screen(ol, _CursesTerm(stdscr)))
+            return ol.result()
         except Exception:
-            def show():
+            page = max(10, shutil.get_terminal_size().lines-6)
+            def show(focus=0):
+                # 只列出 focus 附近的一页
+                a = max(0, min(focus-page//2, len(ol)-page)); b = min(len(ol), a+page)
                 print("\n当前排序与序号：")
-                for pos, it in enumerate(items, 1):
-                    print(f"  {pos:>2}. [{it['idx']}] {it['name']}")
-                print("命令: m i pos | s i j | set i N | start N | auto | c i | done | help")
+                for pos in range(a, b):
+                    print(f"  {pos+1:>2}. [{ol.idx[pos]}] {ol.names[pos]}")
+                if b-a < len(ol):
+                    print(f"  （共 {len(ol)} 本，显示 {a+1}-{b}；l 位置 查看其他部分）")
+                print("命令: m i pos | s i j | set i N | start N | auto | c i | l pos | done | help")
             show()
             while True:
                 try:
@@ -337,56 +1654,48 @@ def interactive_order_indices(flist, start=1):
                     print("  start N   设置起始序号")
                     print("  auto      从起始序号自动连续编号")
                     print("  c i       从第 i 项当前序号开始向后连续编号")
+                    print("  l pos     列出 pos 附近的一页")
                     show()
                     continue
                 parts = cmd.split()
                 try:
                     if parts[0] == "m" and len(parts) == 3:
                         i = int(parts[1]); pos = int(parts[2])
-                        if not (1 <= i <= len(items) and 1 <= pos <= len(items)):
+                        if not (1 <= i <= len(ol) and 1 <= pos <= len(ol)):
                             print("范围无效"); continue
-                        it = items.pop(i-1)
-                        items.insert(pos-1, it)
-                        show()
+                        ol.move(i-1, pos-1)
+                        show(pos-1)
                     elif parts[0] == "s" and len(parts) == 3:
                         i = int(parts[1]); j = int(parts[2])
-                        if not (1 <= i <= len(items) and 1 <= j <= len(items)):
+                        if not (1 <= i <= len(ol) and 1 <= j <= len(ol)):
                             print("范围无效"); continue
-                        items[i-1], items[j-1] = items[j-1], items[i-1]
-                        show()
+                        ol.swap(i-1, j-1)
+                        show(j-1)
                     elif parts[0] == "set" and len(parts) == 3:
-                        i = int(parts[1]); v = float(parts[2]) if "." in parts[2] else int(parts[2])
-                        if not (1 <= i <= len(items)):
+                        i = int(parts[1]); v = _num(parts[2])
+                        if not (1 <= i <= len(ol)):
                             print("范围无效"); continue
-                        items[i-1]["idx"] = v
-                        show()
+                        ol.idx[i-1] = v
+                        show(i-1)
                     elif parts[0] == "start" and len(parts) == 2:
-                        start = float(parts[1]) if "." in parts[1] else int(parts[1])
+                        ol.start = _num(parts[1])
                         show()
                     elif parts[0] == "auto" and len(parts) == 1:
-                        cur = start
-                        for it in items:
-                            it["idx"] = cur
-                            cur = cur + 1
+                        ol.renumber()
                         show()
                     elif parts[0] == "c" and len(parts) == 2:
                         i = int(parts[1])
-                        if not (1 <= i <= len(items)):
+                        if not (1 <= i <= len(ol)):
                             print("范围无效"); continue
-                        cur0 = items[i-1]["idx"]
-                        cur = (math.ceil(cur0) if isinstance(cur0, float) and not float(cur0).is_integer() else (cur0 + 1))
-                        items[i-1]["idx"] = cur0
-                        for j in range(i, len(items)):
-                            items[j]["idx"] = cur
-                            cur = cur + 1
-                        show()
+                        ol.renumber(i)
+                        show(i-1)
+                    elif parts[0] == "l" and len(parts) == 2:
+                        show(int(parts[1])-1)
                     else:
                         print("未知命令，输入 help 查看用法。")
                 except Exception:
                     print("命令解析失败，请重试。")
-            order = [it["file"] for it in items]
-            idx_map = {it["file"]: it["idx"] for it in items}
-            return order, idx_map
+            return ol.result()
 
 def interactive():
     print("交互模式：按提示配置处理选项")
@@ -414,44 +1723,98 @@ def interactive():
                 backup_dir = None
             else:
                 print(f"备份将保存到: {backup_dir}，并保留相对结构自: {base_for_backup}")
-    files=find_epubs(path,rec)
-    if not files:
+    plan_path = plan_out = None
+    while not dry:
+        plan_path = input("保存为计划文件稍后用 --commit-plan 提交(输入文件路径，留空=边确认边在后台写回): ").strip() or None
+        if not plan_path: break
+        try:
+            plan_out = open(plan_path, "w", encoding="utf-8")
+            break
+        except OSError as e:
+            print(f"无法写入计划文件: {e}")
+    files=_peek(find_epubs(path,rec))
+    if files is None:
+        if plan_out is not None: plan_out.close()
         print("未找到EPUB文件"); return
-    print(f"发现 {len(files)} 个EPUB")
     by_folder = by_folder_first
     ok=skip=err=0
+    # 规划与提交分离：逐本做出决定并生成新 OPF，写回交给后台线程（或写入计划文件），回答下一个文件夹的提问时磁盘不空闲
+    plan_base = os.path.dirname(os.path.abspath(plan_path)) if plan_path else None
+    committer = None if dry or plan_out else PlanCommitter(backup, backup_dir, base_for_backup)
+    batch = []
+    # 统计已有系列时打开的会话，规划时直接沿用
+    sessions = {}
+    def handle(f, ser, idx, force=False, skip=False):
+        # 后台写回时会话随计划记录交给提交线程，每本书只打开一次
+        rec = plan_file(f, ser, idx, force, skip, write_collection, write_calibre, book=sessions.pop(f, None), keep=committer is not None)
+        if isinstance(rec, str): return rec
+        if dry: return f"预览: {f} -> {rec['series']}"
+        if plan_out:
+            write_plan_record(plan_out, rec, plan_base)
+            return f"计划: {f} -> {rec['series']}"
+        batch.append(rec)
+        if len(batch) >= 64: flush()
+    def tally(res):
+        nonlocal ok, skip
+        if res is None: return  # 已交给后台写回，结果稍后报告
+        print(res)
+        if res.startswith(("完成", "计划")): ok+=1
+        elif res.startswith("跳过"): skip+=1
+    def flush(wait=False):
+        # 把本批计划交给后台写回，并报告已完成的写回
+        nonlocal err
+        if committer is None: return
+        committer.submit(batch[:]); batch.clear()
+        for f, res, e in committer.results(wait):
+            if e is not None:
+                err+=1; print(f"错误: {f}: {e}")
+            else:
+                tally(res)
     if by_folder:
         mode = "i"
-        # 按父目录分组逐个决策
-        groups = {}
-        for f in sorted(files):
-            d=str(pathlib.Path(f).parent)
-            groups.setdefault(d, []).append(f)
+        # 按父目录分组逐个决策（遍历时同一文件夹的书是连续产出的）
+        groups = ((d, list(g)) for d, g in itertools.groupby(files, key=lambda f: str(pathlib.Path(f).parent)))
         # 增加快速选项：da/ca/ia/sa 表示将当前选择应用到后续所有文件夹
         apply_to_all = False
         global_choice = None  # "d"/"c"/"i"/"s"
         global_ser = None     # 当 global_choice=="c" 时的统一系列名
         global_use_existing = False  # 是否启用优先沿用已有系列
-        def has_series_and_value(fp):
+        # 已读取过的系列值，避免统计与逐本处理时重复打开同一本书
+        series_seen = {}
+        def has_series_and_value(fp, keep=False):
+            # keep=True 时会话保持打开，交给 handle 规划与写回
+            if fp in series_seen:
+                return series_seen[fp]
+            book = EpubBook(fp)
             try:
-                with zipfile.ZipFile(fp,"r") as z:
-                    opf=find_opf(z); data=z.read(opf)
-                _, meta = parse_opf(data)
+                meta = parse_opf_metadata(book.read_opf()[1])
                 val = get_series(meta)
-                return (val is not None and val!=""), val
+                r = ((val is not None and val!=""), val)
             except Exception:
-                return False, None
+                r = (False, None)
+                keep = False
+            if keep: sessions[fp] = book
+            else: book.close()
+            series_seen[fp] = r
+            return r
         def folder_series_counts(lst):
-            cnt={}
+            # 写法不同的同一系列（全半角、繁简、卷号后缀）合并计数，以出现最多的写法显示
+            # 文件夹不大时统计用的会话保持打开，规划时不再重新打开（限制同时打开的文件数）
+            groups=collections.defaultdict(collections.Counter)
             miss=0
             for f in lst:
-                okv, v = has_series_and_value(f)
+                okv, v = has_series_and_value(f, keep=len(lst)<=256)
                 if okv and v:
-                    cnt[v]=cnt.get(v,0)+1
+                    groups[normalize_series(v)][v]+=1
                 else:
                     miss+=1
-            return cnt, miss
-        for d, flist in groups.items():
+            cnt={c.most_common(1)[0][0]:sum(c.values()) for c in groups.values()}
+            return cnt, miss, sum(len(c) for c in groups.values())
+        for d, flist in groups:
+            flush()
+            # 上一个文件夹中未规划的书（跳过或出错）关闭其会话
+            for b in sessions.values(): b.close()
+            sessions.clear()
             dname = pathlib.Path(d).name
             print(f"\n文件夹: {d} (共 {len(flist)} 本)")
             if not apply_to_all:
@@ -496,15 +1859,21 @@ def interactive():
                     start_idx = int(sraw) if sraw else 1
                 except Exception:
                     start_idx = 1
-                final_list, indices_map = interactive_order_indices(flist, start_idx)
+                oraw = input("初始排序 [n=名称,a=自然数字,v=卷号,d=出版日期,p=已有序号] (默认 n): ").strip().lower()
+                order = {"a":"natural","v":"volume","d":"date","p":"position"}.get(oraw, "name")
+                final_list, indices_map = interactive_order_indices(list(order_files(flist, order)), start_idx)
 
             folder_ser = None
             override_minority = False
             if use_existing:
-                cnt, miss = folder_series_counts(final_list)
+                cnt, miss, spellings = folder_series_counts(final_list)
                 if cnt:
                     if len(cnt) == 1:
                         folder_ser = next(iter(cnt.keys()))
+                        if spellings > 1:
+                            # 只是写法不同的同一系列，预选出现最多的写法，是否统一仍由用户确认
+                            print(f"提示：该文件夹内的系列写法不一致，出现最多的写法: {folder_ser}")
+                            override_minority = ask_yn("是否将其他不同系列统一为选定系列?", default=True)
                     else:
                         print("提示：该文件夹内已有系列不一致：")
                         for k,v in sorted(cnt.items(), key=lambda x: (-x[1], x[0])):
@@ -530,12 +1899,12 @@ def interactive():
                                 if mode=='s':
                                     res=f"跳过(已有): {f}"
                                 elif mode=='f':
-                                    res=process_file(f,folder_ser,idx_use,force=True,skip=False,dry=dry,backup=backup,backup_dir=backup_dir,backup_base=base_for_backup,write_collection=write_collection,write_calibre=write_calibre)
+                                    res=handle(f,folder_ser,idx_use,force=True,skip=False)
                                 else:
-                                    res=process_file(f,folder_ser,idx_use,force=False,skip=False,dry=dry,backup=backup,backup_dir=backup_dir,backup_base=base_for_backup,write_collection=write_collection,write_calibre=write_calibre)
+                                    res=handle(f,folder_ser,idx_use,force=False,skip=False)
                             else:
                                 if override_minority:
-                                    res=process_file(f,folder_ser,idx_use,force=True,skip=False,dry=dry,backup=backup,backup_dir=backup_dir,backup_base=base_for_backup,write_collection=write_collection,write_calibre=write_calibre)
+                                    res=handle(f,folder_ser,idx_use,force=True,skip=False)
                                 else:
                                     res=f"跳过(保留不同系列): {f}"
                         else:
@@ -544,10 +1913,8 @@ def interactive():
                             if apply_ser is None:
                                 res=f"跳过(无系列且策略为跳过): {f}"
                             else:
-                                res=process_file(f,apply_ser,idx_use,force=(mode=='f'),skip=(mode=='s'),dry=dry,backup=backup,backup_dir=backup_dir,backup_base=base_for_backup,write_collection=write_collection,write_calibre=write_calibre)
-                        print(res)
-                        if res.startswith("完成"): ok+=1
-                        elif res.startswith("跳过"): skip+=1
+                                res=handle(f,apply_ser,idx_use,force=(mode=='f'),skip=(mode=='s'))
+                        tally(res)
                     except Exception as e:
                         err+=1; print(f"错误: {f}: {e}")
             elif choice == "c":
@@ -556,14 +1923,12 @@ def interactive():
                     try:
                         idx_use = (indices_map[f] if indices_map else None)
                         if mode=='f':
-                            res=process_file(f,ser,idx_use,force=True,skip=False,dry=dry,backup=backup,backup_dir=backup_dir,backup_base=base_for_backup,write_collection=write_collection,write_calibre=write_calibre)
+                            res=handle(f,ser,idx_use,force=True,skip=False)
                         elif mode=='s':
-                            res=process_file(f,ser,idx_use,force=False,skip=True,dry=dry,backup=backup,backup_dir=backup_dir,backup_base=base_for_backup,write_collection=write_collection,write_calibre=write_calibre)
+                            res=handle(f,ser,idx_use,force=False,skip=True)
                         else:
-                            res=process_file(f,ser,idx_use,force=False,skip=False,dry=dry,backup=backup,backup_dir=backup_dir,backup_base=base_for_backup,write_collection=write_collection,write_calibre=write_calibre)
-                        print(res)
-                        if res.startswith("完成"): ok+=1
-                        elif res.startswith("跳过"): skip+=1
+                            res=handle(f,ser,idx_use,force=False,skip=False)
+                        tally(res)
                     except Exception as e:
                         err+=1; print(f"错误: {f}: {e}")
             elif choice == "i":
@@ -574,14 +1939,12 @@ def interactive():
                     try:
                         idx_use = (indices_map[f] if indices_map else None)
                         if mode=='f':
-                            res=process_file(f,ser_each,idx_use,force=True,skip=False,dry=dry,backup=backup,backup_dir=backup_dir,backup_base=base_for_backup,write_collection=write_collection,write_calibre=write_calibre)
+                            res=handle(f,ser_each,idx_use,force=True,skip=False)
                         elif mode=='s':
-                            res=process_file(f,ser_each,idx_use,force=False,skip=True,dry=dry,backup=backup,backup_dir=backup_dir,backup_base=base_for_backup,write_collection=write_collection,write_calibre=write_calibre)
+                            res=handle(f,ser_each,idx_use,force=False,skip=True)
                         else:
-                            res=process_file(f,ser_each,idx_use,force=False,skip=False,dry=dry,backup=backup,backup_dir=backup_dir,backup_base=base_for_backup,write_collection=write_collection,write_calibre=write_calibre)
-                        print(res)
-                        if res.startswith("完成"): ok+=1
-                        elif res.startswith("跳过"): skip+=1
+                            res=handle(f,ser_each,idx_use,force=False,skip=False)
+                        tally(res)
                     except Exception as e:
                         err+=1; print(f"错误: {f}: {e}")
             else:
@@ -591,14 +1954,12 @@ def interactive():
                         ser_d=dname
                         idx_use = (indices_map[f] if indices_map else None)
                         if mode=='f':
-                            res=process_file(f,ser_d,idx_use,force=True,skip=False,dry=dry,backup=backup,backup_dir=backup_dir,backup_base=base_for_backup,write_collection=write_collection,write_calibre=write_calibre)
+                            res=handle(f,ser_d,idx_use,force=True,skip=False)
                         elif mode=='s':
-                            res=process_file(f,ser_d,idx_use,force=False,skip=True,dry=dry,backup=backup,backup_dir=backup_dir,backup_base=base_for_backup,write_collection=write_collection,write_calibre=write_calibre)
+                            res=handle(f,ser_d,idx_use,force=False,skip=True)
                         else:
-                            res=process_file(f,ser_d,idx_use,force=False,skip=False,dry=dry,backup=backup,backup_dir=backup_dir,backup_base=base_for_backup,write_collection=write_collection,write_calibre=write_calibre)
-                        print(res)
-                        if res.startswith("完成"): ok+=1
-                        elif res.startswith("跳过"): skip+=1
+                            res=handle(f,ser_d,idx_use,force=False,skip=False)
+                        tally(res)
                     except Exception as e:
                         err+=1; print(f"错误: {f}: {e}")
     else:
@@ -609,23 +1970,29 @@ def interactive():
         print(f"处理模式：{('覆盖' if mode=='f' else '跳过' if mode=='s' else '逐本确认')}, 递归：{rec}, 预览：{dry}, 备份：{backup}")
         go=ask_yn("开始执行?", default=True)
         if not go:
+            if plan_out is not None: plan_out.close()
             print("已取消"); return
         for f in files:
             try:
                 if mode=='f':
-                    res=process_file(f,series,None,force=True,skip=False,dry=dry,backup=backup,backup_dir=backup_dir,backup_base=base_for_backup,write_collection=write_collection,write_calibre=write_calibre)
+                    res=handle(f,series,None,force=True,skip=False)
                 elif mode=='s':
-                    res=process_file(f,series,None,force=False,skip=True,dry=dry,backup=backup,backup_dir=backup_dir,backup_base=base_for_backup,write_collection=write_collection,write_calibre=write_calibre)
+                    res=handle(f,series,None,force=False,skip=True)
                 else:
-                    res=process_file(f,series,None,force=False,skip=False,dry=dry,backup=backup,backup_dir=backup_dir,backup_base=base_for_backup,write_collection=write_collection,write_calibre=write_calibre)
-                print(res)
-                if res.startswith("完成"): ok+=1
-                elif res.startswith("跳过"): skip+=1
+                    res=handle(f,series,None,force=False,skip=False)
+                tally(res)
             except Exception as e:
                 err+=1; print(f"错误: {f}: {e}")
+    flush(wait=True)
+    for b in sessions.values(): b.close()
+    if committer is not None: committer.close()
+    if plan_out is not None:
+        plan_out.close()
+        print(f"计划已保存: {plan_path}，用 --commit-plan {plan_path} 提交")
     print(f"结果: 成功{ok}, 跳过{skip}, 错误{err}")
 
 def main():
+    global TIMING_HOOK,COPY_BUFSIZE,COMPRESSION,COMPRESS_LEVEL,COMPRESS_THREADS
     # 无参数时默认进入交互模式
     if len(sys.argv) == 1:
         interactive(); return
@@ -644,62 +2011,494 @@ def main():
     # 自动序号相关
     ap.add_argument("--auto-index",action="store_true",help="按文件顺序自动分配系列序号")
     ap.add_argument("--auto-index-start",type=int,default=1,help="自动序号起始值(默认1)")
+    ap.add_argument("--order",choices=ORDER_STRATEGIES,default="name",help="自动序号的排序方式：name=按名称(默认)，natural=数字按数值，volume=文件名中的卷号，date=OPF出版日期，position=已有序号")
     ap.add_argument("--write-calibre",action="store_true",help="同时写入calibre:series与calibre:series_index")
     ap.add_argument("--no-collection",dest="write_collection",action="store_false",help="不写入belongs-to-collection与group-position")
+    ap.add_argument("--set",action="append",default=[],metavar="FIELD=VALUE",help=f"同时设置其他元数据字段({'/'.join(EDIT_FIELDS)})，可重复；cover为封面图片的manifest id")
+    ap.add_argument("--replace",action="append",nargs=3,default=[],metavar=("FIELD","OLD","NEW"),help="把字段中等于OLD的值改为NEW，可重复")
+    ap.add_argument("--delete",action="append",default=[],metavar="FIELD[=VALUE]",help="删除字段(指定VALUE时只删除该值)及其refines细化信息，可重复")
+    ap.add_argument("--no-series",action="store_true",help="不写入系列标签，只执行--set/--replace/--delete")
+    ap.add_argument("--in-place",action="store_true",help="原地追加新OPF与中央目录，不重建整个文件；备份仅保存原中央目录与OPF")
+    ap.add_argument("--jobs","-j",type=int,default=1,help="并发处理的线程数(默认1)")
+    ap.add_argument("--cache",nargs="?",const="",help="使用持久化扫描索引跳过未变化且已是目标系列的书(可指定数据库文件，默认在--path下的.epub_series_index.sqlite)")
+    ap.add_argument("--export",metavar="FILE",help="只读导出当前系列状态(JSONL或CSV，按扩展名判断；-为标准输出)，可配合-j并发")
+    ap.add_argument("--export-format",choices=("jsonl","csv"),help="导出格式(默认按--export扩展名)")
+    ap.add_argument("--journal",metavar="FILE",help="追加写批处理日志(JSON Lines)，记录每本的计划写入、提交与备份位置，用于--resume")
+    ap.add_argument("--resume",action="store_true",help="按--journal续跑：跳过已完成且未再变化的书，清理中断遗留的.tmp")
+    ap.add_argument("--watch",action="store_true",help="监视模式：常驻运行，只为新增或变化的书写入系列(已有系列默认跳过，--force时覆盖)")
+    ap.add_argument("--watch-settle",type=float,default=5.0,help="文件大小与修改时间保持不变多少秒后才处理(默认5)")
+    ap.add_argument("--watch-poll",action="store_true",help="不使用inotify，改为定期扫描(NFS/SMB等网络存储上需要)")
+    ap.add_argument("--watch-interval",type=float,default=10.0,help="定期扫描的间隔秒数(默认10)")
+    ap.add_argument("--consolidate",metavar="FILE",help="扫描全库，把写法不同的同一系列(全半角、繁简、卷号后缀、近似拼写)归并为书最多的写法，输出可用--manifest应用的清单")
+    ap.add_argument("--similarity",type=float,default=0.85,help="--consolidate 近似拼写的相似度阈值(0-1，默认0.85)")
+    ap.add_argument("--manifest",help="按清单批量应用(CSV或JSONL，字段path,series,index,tags)，流式读取，每本只处理一次")
+    ap.add_argument("--save-plan",metavar="FILE",help="只规划不写回：做出全部决定，把新的OPF写入计划文件(JSONL)，稍后用--commit-plan提交")
+    ap.add_argument("--commit-plan",metavar="FILE",help="提交计划文件：按磁盘与文件夹顺序写回，规划后被改动过的书跳过；可在存储主机上无人值守执行")
+    ap.add_argument("--async-io",type=int,metavar="N",help="异步I/O模式：最多N个读写同时进行，适合NFS/SMB等高延迟存储(同一文件夹内按顺序写回)")
+    ap.add_argument("--timings",metavar="FILE",help="逐本写出分阶段耗时记录(JSON Lines)：打开、查找OPF、读取、解析、注入、重写、备份、改名，以及读写字节数、条目数与是否回退清理")
+    ap.add_argument("--profile",metavar="FILE",help="用cProfile记录整次运行并保存pstats文件(仅统计主线程，建议配合-j 1使用)")
+    ap.add_argument("--buffer-size",type=int,metavar="BYTES",help=f"复制条目时的分块大小(默认{COPY_BUFSIZE})，决定每个线程的内存占用上限")
+    ap.add_argument("--stats",action="store_true",help="结束时输出归档打开次数统计")
+    ap.add_argument("--compression",choices=COMPRESSION_MODES,default="preserve",help="重写归档时的压缩策略：preserve=保留各条目原压缩方式(默认)，store-media=图片/字体/音视频等已压缩格式改为不压缩，recompress=按--compress-level重新压缩文本条目，repack=同--repack")
+    ap.add_argument("--compress-level",type=int,choices=range(0,10),default=COMPRESS_LEVEL,metavar="0-9",help=f"重新压缩的级别(默认{COMPRESS_LEVEL})")
+    ap.add_argument("--repack",action="store_true",help="整体重新打包：媒体不压缩，其余条目按--compress-level多线程重新压缩(无收益时不压缩)；配合--compact可不改元数据只压缩书库")
+    ap.add_argument("--compress-threads",type=int,metavar="N",help="重新压缩的线程数(默认：--repack 时为CPU核数，否则为1)")
+    ap.add_argument("--compact",action="store_true",help="整理归档，清除原地修改遗留的旧OPF死字节(不修改元数据)")
+    ap.add_argument("--backup-store",help="使用内容寻址备份库(目录)代替逐本.bak，相同内容只存一份")
+    ap.add_argument("--backup-mode",choices=("opf","full"),default="opf",help="备份库模式：opf=仅保存原OPF与中央目录(默认)，full=整本(优先硬链接/reflink)")
+    ap.add_argument("--restore",action="store_true",help="恢复--path下各书最近一次的备份（备份库，或未指定--backup-store时的.cd.bak/.bak）")
+    ap.add_argument("--gc-backups",action="store_true",help="清理备份库：每本只保留最近--backup-keep条记录并删除无引用对象")
+    ap.add_argument("--backup-keep",type=int,default=1,help="清理备份库时每本保留的记录数(默认1)")
     ap.set_defaults(write_collection=True)
     args=ap.parse_args()
     if args.interactive:
         interactive(); return
-    files=find_epubs(args.path,args.recursive)
-    if not files:
-        print("未找到EPUB文件"); return
-    files = sorted(files)
-    print(f"待处理 {len(files)} 个EPUB")
+    # 字段编辑按 删除、替换、设置 的顺序执行
+    args.edits=[]
+    for op,vals in (("delete",args.delete),("replace",args.replace),("set",args.set)):
+        for v in vals:
+            if op=="replace": e=("replace",*v)
+            else:
+                f,eq,val=v.partition("=")
+                if op=="set" and not eq: ap.error(f"--set 需要 FIELD=VALUE: {v}")
+                e=(op,f,val) if eq else (op,f)
+            if e[1] not in EDIT_FIELDS: ap.error(f"不支持的字段: {e[1]}（可用: {', '.join(EDIT_FIELDS)}）")
+            args.edits.append(e)
+    if args.no_series:
+        if not args.edits: ap.error("--no-series 需要配合 --set/--replace/--delete 使用")
+        args.write_collection=args.write_calibre=False
+    if args.manifest and (args.restore or args.compact or args.auto_index or args.export or args.consolidate):
+        ap.error("--manifest 不能与 --restore/--compact/--auto-index/--export/--consolidate 同时使用")
+    if args.commit_plan and (args.manifest or args.save_plan or args.restore or args.compact or args.export or args.consolidate or args.watch):
+        ap.error("--commit-plan 不能与 --manifest/--save-plan/--restore/--compact/--export/--consolidate/--watch 同时使用")
+    if args.save_plan and (args.dry_run or args.restore or args.compact or args.export or args.consolidate or args.watch):
+        ap.error("--save-plan 不能与 --dry-run/--restore/--compact/--export/--consolidate/--watch 同时使用")
+    if (args.save_plan or args.commit_plan) and args.async_io:
+        ap.error("--save-plan/--commit-plan 不能与 --async-io 同时使用")
+    if args.in_place and not args.compact and (args.repack or args.compression!="preserve"):
+        ap.error("--in-place 不重写条目，不能与 --compression/--repack 同时使用（可先写入，再用 --compact 整理压缩）")
+    if args.resume and not args.journal:
+        ap.error("--resume 需要同时指定 --journal")
+    if args.gc_backups and not args.backup_store:
+        ap.error("--gc-backups 需要同时指定 --backup-store")
+    if args.buffer_size:
+        COPY_BUFSIZE=max(4096,args.buffer_size)
+    COMPRESSION="repack" if args.repack else args.compression
+    COMPRESS_LEVEL=args.compress_level
+    COMPRESS_THREADS=max(1,args.compress_threads or ((os.cpu_count() or 1) if COMPRESSION=="repack" else 1))
+    store=BackupStore(args.backup_store,args.backup_mode) if args.backup_store else None
+    tfile=open(args.timings,"w",encoding="utf-8") if args.timings else None
+    if tfile is not None:
+        tlock=threading.Lock()
+        def hook(rec):
+            line=json.dumps(rec,ensure_ascii=False)+"\n"
+            with tlock: tfile.write(line)
+        TIMING_HOOK=hook
+    prof=None
+    if args.profile:
+        import cProfile
+        prof=cProfile.Profile(); prof.enable()
+    try:
+        if args.gc_backups:
+            refs,objs,freed=store.gc(max(1,args.backup_keep))
+            print(f"结果: 删除记录{refs}, 删除对象{objs}, 释放{freed/(1<<20):.1f}MB")
+            return
+        run_main(args,store)
+    finally:
+        if prof is not None:
+            import pstats
+            prof.disable(); prof.dump_stats(args.profile)
+            pstats.Stats(prof,stream=sys.stderr).sort_stats("cumulative").print_stats(15)
+        if tfile is not None:
+            TIMING_HOOK=None; tfile.close()
+        if store is not None: store.close()
+def run_watch(args,store=None):
+    # 监视模式：只处理新增或变化的书；已有系列默认跳过（--force 时覆盖），不进行交互提问
+    if not os.path.isdir(args.path):
+        print(f"错误: 监视模式需要文件夹路径: {args.path}"); return
+    base_for_backup=args.backup_base or args.path
+    cache=ScanCache(args.cache or ScanCache.default_path(args.path)) if args.cache is not None else None
+    journal=RunJournal(args.journal) if args.journal and not args.dry_run else None
+    done={}
+    print(f"监视: {args.path}（Ctrl+C 退出）")
+    try:
+        for f in watch_epubs(args.path,args.recursive,args.watch_settle,args.watch_interval,args.watch_poll,done=done):
+            try:
+                res=process_file(f,args.series,args.index,args.force,not args.force,args.dry_run,backup=not args.no_backup,backup_dir=args.backup_dir,backup_base=base_for_backup,write_collection=args.write_collection,write_calibre=args.write_calibre,in_place=args.in_place,cache=cache,store=store,journal=journal,edits=args.edits)
+                st=os.stat(f); done[f]=(st.st_size,st.st_mtime_ns)
+                print(res)
+            except Exception as e:
+                print(f"错误: {f}: {e}")
+    except KeyboardInterrupt:
+        print("已停止监视")
+    finally:
+        if cache is not None: cache.close()
+        if journal is not None: journal.close()
+def run_main(args,store=None):
+    if args.watch:
+        run_watch(args,store); return
+    if args.commit_plan:
+        try:
+            for _ in read_plan(args.commit_plan): pass
+        except (OSError,ValueError) as e:
+            print(f"错误: 计划 {args.commit_plan}: {e}"); return
+        items=plan_manifest(read_plan(args.commit_plan))
+    elif args.manifest:
+        try:
+            # 先完整校验一遍清单，避免处理到中途才发现格式错误
+            for _ in read_manifest(args.manifest): pass
+        except (OSError,ValueError) as e:
+            print(f"错误: 清单 {args.manifest}: {e}"); return
+        items=plan_manifest(read_manifest(args.manifest))
+    else:
+        files=_peek(find_epubs(args.path,args.recursive))
+        if files is None:
+            print("未找到EPUB文件"); return
+        if args.export:
+            cache=ScanCache(args.cache or ScanCache.default_path(args.path)) if args.cache is not None else None
+            fmt=args.export_format or ("csv" if args.export.lower().endswith(".csv") else "jsonl")
+            out=sys.stdout if args.export=="-" else open(args.export,"w",encoding="utf-8",newline="")
+            try:
+                n,bad=export_series(files,out,fmt,args.jobs,cache)
+            finally:
+                if out is not sys.stdout: out.close()
+                if cache is not None: cache.close()
+            log=sys.stderr if out is sys.stdout else sys.stdout
+            if args.stats: print(f"统计: 打开归档 {sum(BOOK_OPENS.values())} 次，涉及 {len(BOOK_OPENS)} 本",file=log)
+            print(f"结果: 导出{n}, 解析错误{bad}",file=log)
+            return
+        if args.consolidate:
+            cache=ScanCache(args.cache or ScanCache.default_path(args.path)) if args.cache is not None else None
+            fmt="csv" if args.consolidate.lower().endswith(".csv") else "jsonl"
+            try:
+                with open(args.consolidate,"w",encoding="utf-8",newline="") as out:
+                    merged,n=consolidate_series(files,out,fmt,args.jobs,cache,args.similarity)
+            finally:
+                if cache is not None: cache.close()
+            for name,variants in merged:
+                print(f"合并: {name} <- "+", ".join(f"{v}({c})" for v,c in sorted(variants.items(),key=lambda kv:-kv[1])))
+            print(f"结果: 合并{len(merged)}组, 需修改{n}本；确认后用 --manifest {args.consolidate} 应用")
+            return
+        if args.restore:
+            ok=miss=err=0
+            base_for_backup=args.backup_base or (args.path if pathlib.Path(args.path).is_dir() else str(pathlib.Path(args.path).parent))
+            for f in files:
+                try:
+                    if store is not None:
+                        how=store.restore(f) if not args.dry_run else store.latest(f) and "预览"
+                    else:
+                        # 未指定备份库时按 <文件>.cd.bak / <文件>.bak 恢复（--backup-dir/--backup-base 同写入时）
+                        bak=find_backup_file(f,args.backup_dir,base_for_backup)
+                        how=bak and ("预览" if args.dry_run else restore_backup_file(f,bak))
+                    if how is None:
+                        miss+=1; print(f"无备份: {f}"); continue
+                    print(f"恢复({how}): {f}"); ok+=1
+                except Exception as e:
+                    err+=1; print(f"错误: {f}: {e}")
+            print(f"结果: 恢复{ok}, 无备份{miss}, 错误{err}")
+            return
+        if args.compact:
+            ok=err=0
+            for f in files:
+                try:
+                    recover_inplace(f)
+                    if not args.dry_run: compact_epub(f)
+                    print(f"整理: {f}"); ok+=1
+                except Exception as e:
+                    err+=1; print(f"错误: {f}: {e}")
+            print(f"结果: 整理{ok}, 错误{err}")
+            return
+        # 自动序号按遍历顺序递增：文件夹内按 --order 排序，文件夹之间按深度优先的名称顺序
+        if args.auto_index:
+            # 惰性排序：扫描缓存在开始处理前才打开
+            def ordered(files):
+                yield from order_files(files,args.order,args.jobs,cache)
+            files=ordered(files)
+        items=({"path":f,"series":None,"index":i if args.auto_index else None,"tags":None} for i,f in enumerate(files,args.auto_index_start))
     ok=skip=err=0
     base_for_backup = args.backup_base or (args.path if pathlib.Path(args.path).is_dir() else str(pathlib.Path(args.path).parent))
-    indices_map = {f: args.auto_index_start + i for i, f in enumerate(files)} if args.auto_index else None
-    for f in files:
-        try:
-            idx_use = (indices_map[f] if indices_map else args.index)
-            res=process_file(f,args.series,idx_use,args.force,args.skip_existing,args.dry_run,backup=not args.no_backup,backup_dir=args.backup_dir,backup_base=base_for_backup,write_collection=args.write_collection,write_calibre=args.write_calibre)
+    # 清单行中留空的系列名、序号与标签类型沿用命令行参数
+    def opts(it):
+        wc,wk=it["tags"] or (args.write_collection,args.write_calibre)
+        return it["series"] or args.series, args.index if it["index"] is None else it["index"], wc, wk
+    def precheck(it):
+        if it.get("dup"): return f"跳过(清单重复): {it['path']}"
+        if resumed is not None and resumed.finished(it["path"]): return f"跳过(已完成): {it['path']}"
+    def work(it):
+        res=precheck(it)
+        if res: return res
+        if args.commit_plan:
+            if args.dry_run: return f"预览: {it['path']} -> {it['series']}"
+            return commit_plan_entry(it,not args.no_backup,args.backup_dir,base_for_backup,args.in_place,cache,store,journal)
+        ser,idx,wc,wk=opts(it)
+        if args.save_plan:
+            return plan_file(it["path"],ser,idx,args.force,args.skip_existing,wc,wk,cache,args.edits,ask=False)
+        return process_file(it["path"],ser,idx,args.force,args.skip_existing,args.dry_run,backup=not args.no_backup,backup_dir=args.backup_dir,backup_base=base_for_backup,write_collection=wc,write_calibre=wk,in_place=args.in_place,cache=cache,store=store,journal=journal,edits=args.edits,ask=False)
+    def resume(it,job):
+        # 主线程确认替换后继续编辑与写回（或生成计划记录）
+        _,idx,wc,wk=opts(it)
+        if args.save_plan: return plan_record(job,idx,wc,wk,args.edits)
+        return finish_file(job,idx,args.dry_run,not args.no_backup,args.backup_dir,base_for_backup,wc,wk,args.in_place,cache,store,journal,args.edits)
+    cache=ScanCache(args.cache or ScanCache.default_path(args.path)) if args.cache is not None else None
+    journal=RunJournal(args.journal) if args.journal and not args.dry_run and not args.save_plan else None
+    # 预览或保存计划时不写日志，但 --resume 仍按日志跳过已完成的书
+    resumed=(journal or RunJournal(args.journal,readonly=True)) if args.resume else None
+    if args.resume and journal is not None:
+        # 上次中断时正在写回的书：原文件未被替换，遗留的 .tmp 不完整或未经确认，删除后重新处理
+        for p in sorted(journal.planned):
+            if os.path.exists(p+".tmp"):
+                os.remove(p+".tmp"); print(f"清理: {p}.tmp")
+        # 计划记录按批落盘，中断时可能尚未写入；因此处理每本书前都检查遗留的 .tmp
+        def cleaned(items):
+            for it in items:
+                tmp=it["path"]+".tmp"
+                # 清单中的重复记录不清理：同一本书可能正在写回
+                if not it.get("dup") and os.path.exists(tmp):
+                    os.remove(tmp)
+                    with PROMPT_LOCK: print(f"清理: {tmp}")
+                yield it
+        items=cleaned(items)
+    if args.async_io:
+        # 异步模式：读取与写回在 I/O 线程上重叠进行，OPF 编辑在单独的执行器中；同一文件夹内按顺序写回
+        def prepare(it,_):
+            res=precheck(it)
+            if res: return res
+            ser,idx,wc,wk=opts(it)
+            return prepare_file(it["path"],ser,idx,args.force,args.skip_existing,args.dry_run,wc,wk,args.in_place,cache,args.edits,ask=False)
+        # 需要确认的书原样传到结果中，由主线程询问
+        def edit(it,job):
+            if isinstance(job,NeedsConfirm): return job
+            _,idx,wc,wk=opts(it)
+            return edit_file(job,idx,args.dry_run,wc,wk,args.edits)
+        def commit(it,job):
+            if isinstance(job,NeedsConfirm): return job
+            return commit_file(job,not args.no_backup,args.backup_dir,base_for_backup,args.in_place,cache,store,journal)
+        steps=[(prepare,"io"),(edit,"cpu"),(commit,"write")]
+        results=run_batch_async(items,steps,args.async_io,key=lambda it: os.path.dirname(it["path"]))
+    else:
+        results=run_batch(items,work,args.jobs)
+    plan_out=open(args.save_plan,"w",encoding="utf-8") if args.save_plan else None
+    def report(it,res,e):
+        nonlocal ok,skip,err
+        with PROMPT_LOCK:
+            if e is not None:
+                err+=1; print(f"错误: {it['path']}: {e}"); return
+            if isinstance(res,dict):
+                write_plan_record(plan_out,res,os.path.dirname(os.path.abspath(args.save_plan)))
+                res=f"计划: {it['path']} -> {res['series']}"
             print(res)
-            if res.startswith("完成"): ok+=1
-            elif res.startswith("跳过"): skip+=1
-        except Exception as e:
-            err+=1; print(f"错误: {f}: {e}")
+            if res.startswith(("完成","计划")): ok+=1
+            elif res.startswith("跳过"):
+                skip+=1
+                if journal is not None and not res.startswith("跳过(已完成)") and os.path.exists(it["path"]):
+                    journal.log("skip",it["path"])
+    # 已有系列的书按输入顺序在主线程询问，确认后的写回交给单独的线程池，完成后按提交顺序输出
+    writer=ThreadPoolExecutor(max_workers=max(1,args.jobs),thread_name_prefix="esconfirm")
+    later=collections.deque()
+    def drain(wait=False):
+        while later and (wait or later[0][1].done()):
+            it,fut=later.popleft()
+            try:
+                report(it,fut.result(),None)
+            except Exception as e:
+                report(it,None,e)
+    try:
+        for it,res,e in results:
+            if isinstance(res,NeedsConfirm):
+                try:
+                    job=res.job if confirm_replace(it["path"],res.old,res.val) else res.decline()
+                except Exception as e:
+                    job=None; report(it,None,e)
+                if job is None: pass
+                elif isinstance(job,str): report(it,job,None)
+                else: later.append((it,writer.submit(resume,it,job)))
+            else:
+                report(it,res,e)
+            drain()
+        drain(True)
+    finally:
+        writer.shutdown()
+        if cache is not None: cache.close()
+        if journal is not None: journal.close()
+        if plan_out is not None: plan_out.close()
+    if args.stats and BOOK_OPENS:
+        print(f"统计: 打开归档 {sum(BOOK_OPENS.values())} 次，涉及 {len(BOOK_OPENS)} 本，单本最多 {max(BOOK_OPENS.values())} 次")
+    if args.save_plan: print(f"计划已保存: {args.save_plan}，用 --commit-plan {args.save_plan} 提交")
     print(f"结果: 成功{ok}, 跳过{skip}, 错误{err}")
 def xml_escape(t):
     return t.replace('&','&amp;').replace('<','&lt;').replace('>','&gt;')
 
-# 在不改动其他现有内容的前提下，最小化注入系列标签
-def inject_series_minimal(data_bytes, series, index=None, write_collection=True, write_calibre=False):
-    try:
-        s=data_bytes.decode('utf-8')
-    except UnicodeDecodeError:
-        s=data_bytes.decode('utf-8', errors='replace')
-    # 匹配整个 metadata 片段，支持带前缀的标签
-    meta_re=re.compile(r'(<(?P<prefix>[A-Za-z_][\w\-]*:)?metadata\b[^>]*>)(?P<body>.*?)(</(?P=prefix)?metadata>)', re.IGNORECASE|re.DOTALL)
-    m=meta_re.search(s)
+# 需要移除的旧系列标签：每类标签一条模式，同一标签的自闭合形式排在成对形式之前
+_CALIBRE_TAG_PATTERNS=(
+    r'<\s*calibre:series\b[^>]*>.*?</\s*calibre:series\s*>',
+    r'<\s*calibre:series_index\b[^>]*>.*?</\s*calibre:series_index\s*>',
+    r'<\s*meta\b[^>]*\bname\s*=\s*"(?:calibre:series|calibre:series_index)"[^>]*\/>',
+    r'<\s*meta\b[^>]*\bproperty\s*=\s*"(?:calibre:series|calibre:series_index)"[^>]*>.*?</\s*meta\s*>',
+)
+_COLLECTION_TAG_PATTERNS=(
+    r'<\s*meta\b[^>]*\bproperty\s*=\s*"belongs-to-collection"[^>]*\/>',
+    r'<\s*meta\b[^>]*\bproperty\s*=\s*"belongs-to-collection"[^>]*>.*?</\s*meta\s*>',
+    r'<\s*meta\b[^>]*\bproperty\s*=\s*"(?:collection-type|group-position)"[^>]*\/>',
+    r'<\s*meta\b[^>]*\bproperty\s*=\s*"(?:collection-type|group-position)"[^>]*>.*?</\s*meta\s*>',
+)
+def _compile_both(pattern, flags=0):
+    # 同一模式分别编译 str 与 bytes 版本，按输入类型选用
+    return {str: re.compile(pattern, flags), bytes: re.compile(pattern.encode('ascii'), flags)}
+def _tag_re(write_collection,write_calibre):
+    pats=(_CALIBRE_TAG_PATTERNS if write_calibre else ())+(_COLLECTION_TAG_PATTERNS if write_collection else ())
+    return _compile_both('|'.join(pats), re.IGNORECASE|re.DOTALL) if pats else None
+_TAG_RES={(c,k):_tag_re(c,k) for c in (False,True) for k in (False,True)}
+# 所有待移除标签都以这两种开头，先用它快速定位候选位置
+_TAG_START_RE=_compile_both(r'<\s*(?:meta|calibre:series)', re.IGNORECASE)
+_WS_RE=_compile_both(r'\s*')
+def strip_series_tags(body, write_collection=True, write_calibre=False):
+    # 单次扫描 metadata 内容：逐个候选标签判断是否移除，移除时连同两侧空白一起去掉；body 可为 str 或 bytes
+    tag_res=_TAG_RES[(bool(write_collection),bool(write_calibre))]
+    if tag_res is None: return body
+    T=type(body)
+    tag_re=tag_res[T]; start_re=_TAG_START_RE[T]; ws_re=_WS_RE[T]
+    out=[]; last=pos=0
+    while True:
+        m=start_re.search(body,pos)
+        if not m: break
+        t=tag_re.match(body,m.start())
+        if not t:
+            pos=m.start()+1; continue
+        start=m.start()
+        while start>last and body[start-1:start].isspace(): start-=1
+        end=ws_re.match(body,t.end()).end()
+        out.append(body[last:start]); last=pos=end
+    out.append(body[last:])
+    return body[:0].join(out)
+# 匹配整个 metadata 片段，支持带前缀的标签
+_METADATA_RE=_compile_both(r'(<(?P<prefix>[A-Za-z_][\w\-]*:)?metadata\b[^>]*>)(?P<body>.*?)(</(?P=prefix)?metadata>)', re.IGNORECASE|re.DOTALL)
+_INDENT_RE=_compile_both(r'\s*\n([ \t]*)')
+
+# 可编辑的其他元数据字段：title/creator/language 取 dc 元素文本，cover 取 <meta name="cover"> 的 content（封面图片的 manifest id）
+EDIT_FIELDS=("title","creator","language","cover")
+_ATTR_VAL=r'\s*=\s*["\']([^"\']*)["\']'
+_FIELD_RES={f:_compile_both(r'<(?P<p>(?:[A-Za-z_][\w\-]*:)?)'+f+r'(?=[\s/>])(?P<attrs>[^>]*?)(?:/>|>(?P<text>.*?)</(?P=p)'+f+r'\s*>)', re.DOTALL) for f in ("title","creator","language")}
+_FIELD_RES["cover"]=_compile_both(r'<(?P<p>(?:[A-Za-z_][\w\-]*:)?)meta(?=[\s/>])(?P<attrs>[^>]*?\bname\s*=\s*["\']cover["\'][^>]*?)(?:/>|>(?P<text>.*?)</(?P=p)meta\s*>)', re.DOTALL)
+_REFINES_RE=_compile_both(r'<(?P<p>(?:[A-Za-z_][\w\-]*:)?)meta(?=[\s/>])(?P<attrs>[^>]*?\brefines\s*=\s*["\']#(?P<ref>[^"\']*)["\'][^>]*?)(?:/>|>(?P<text>.*?)</(?P=p)meta\s*>)', re.DOTALL)
+_ID_RE=_compile_both(r'\bid'+_ATTR_VAL)
+_CONTENT_RE=_compile_both(r'\bcontent'+_ATTR_VAL)
+_PROPERTY_RE=_compile_both(r'\bproperty'+_ATTR_VAL)
+# 值改变后不再成立的细化信息（排序名、其他文字写法）随之删除，role 等保留
+_STALE_REFINES=("file-as","alternate-script")
+def _attr_escape(v):
+    return xml_escape(v).replace('"','&quot;')
+def _txt(v,enc):
+    return v.decode(enc,'replace') if isinstance(v,bytes) else v
+def _field_items(body,field,enc):
+    # 返回 [(匹配, 值, id)]
+    T=type(body); out=[]
+    for m in _FIELD_RES[field][T].finditer(body):
+        attrs=m.group('attrs')
+        if field=="cover":
+            c=_CONTENT_RE[T].search(attrs); raw=c.group(1) if c else body[:0]
+        else:
+            raw=m.group('text') or body[:0]
+        i=_ID_RE[T].search(attrs)
+        out.append((m,html.unescape(_txt(raw,enc)).strip(),_txt(i.group(1),enc) if i else None))
+    return out
+def _splice(body,spans):
+    # spans 为 [(起, 止, 替换)]，互不重叠；起止相同的删除项会连同前面的空白一起去掉
+    out=[]; last=0
+    for start,end,rep in sorted(spans,key=lambda x: x[0]):
+        if start<last: continue
+        out.append(body[last:start]); out.append(rep); last=end
+    out.append(body[last:])
+    return body[:0].join(out)
+def _removal(body,m):
+    start=m.start()
+    while start>0 and body[start-1:start].isspace(): start-=1
+    return start,m.end(),body[:0]
+def _refines_of(body,ids,enc,props=None):
+    # 沿 refines 链收集细化 ids 的 meta（被细化的 meta 若有 id 也继续向下收集）；props 限定只收集这些 property
+    T=type(body); found=[]; ids=set(ids); seen=set()
+    changed=True
+    while changed:
+        changed=False
+        for m in _REFINES_RE[T].finditer(body):
+            if m.start() in seen or _txt(m.group('ref'),enc) not in ids: continue
+            if props is not None:
+                pm=_PROPERTY_RE[T].search(m.group('attrs'))
+                if not pm or _txt(pm.group(1),enc) not in props: continue
+            seen.add(m.start()); found.append(m); changed=True
+            i=_ID_RE[T].search(m.group('attrs'))
+            if i: ids.add(_txt(i.group(1),enc))
+    return found
+def _set_value(body,field,m,value,enc):
+    enc_=(lambda t: t.encode(enc,'xmlcharrefreplace')) if isinstance(body,bytes) else (lambda t: t)
+    if field=="cover":
+        c=_CONTENT_RE[type(body)].search(m.group('attrs'))
+        if c:
+            off=m.start('attrs')
+            return off+c.start(1),off+c.end(1),enc_(_attr_escape(value))
+        return m.end('attrs'),m.end('attrs'),enc_(f' content="{_attr_escape(value)}"')
+    if m.group('text') is not None:
+        return m.start('text'),m.end('text'),enc_(xml_escape(value))
+    # 自闭合的空元素改为成对形式
+    p=_txt(m.group('p'),enc); attrs=_txt(m.group('attrs'),enc).rstrip()
+    return m.start(),m.end(),enc_(f"<{p}{field}{attrs}>{xml_escape(value)}</{p}{field}>")
+def _new_element(field,value):
+    if field=="cover":
+        return f'<meta name="cover" content="{_attr_escape(value)}" />'
+    return f"<dc:{field}>{xml_escape(value)}</dc:{field}>"
+def apply_field_edit(body,edit,enc,indent="  "):
+    # 对 metadata 内容执行一项编辑，返回 (新内容, 需要在开头插入的新元素文本)
+    # edit 为 ("set", 字段, 值)、("replace", 字段, 旧值, 新值) 或 ("delete", 字段[, 值])
+    op,field=edit[0],edit[1]
+    items=_field_items(body,field,enc)
+    spans=[]; ins=""
+    def drop(targets):
+        ms=[m for m,_,_ in targets]
+        ms+=_refines_of(body,[i for _,_,i in targets if i],enc)
+        spans.extend(_removal(body,m) for m in ms)
+    def change(m,v,ident):
+        spans.append(_set_value(body,field,m,v,enc))
+        if ident: spans.extend(_removal(body,r) for r in _refines_of(body,[ident],enc,_STALE_REFINES))
+    if op=="delete":
+        drop([it for it in items if len(edit)<3 or it[1]==edit[2]])
+    elif op=="replace":
+        for m,v,ident in items:
+            if v==edit[2] and v!=edit[3]: change(m,edit[3],ident)
+    elif op=="set":
+        if not items:
+            ins=f"\n{indent}{_new_element(field,edit[2])}"
+        else:
+            m,v,ident=items[0]
+            if v!=edit[2]: change(m,edit[2],ident)
+            drop(items[1:])
+    else:
+        raise ValueError(f"未知的编辑操作: {op}")
+    return (_splice(body,spans) if spans else body),ins
+
+# 在不改动其他现有内容的前提下，最小化注入系列标签并执行其他字段编辑（一次生成新的 OPF）
+# 保持 OPF 原编码：ASCII 兼容编码（UTF-8、GBK 等）直接在字节上拼接，只有 metadata 内被编辑的位置改变，其余字节原样保留；
+# UTF-16/32 等严格解码后编辑并按原编码与 BOM 写回
+def edit_opf_minimal(data_bytes, edits=(), series=None, index=None, write_collection=True, write_calibre=False):
+    if series is None: write_collection=write_calibre=False
+    enc,_=opf_encoding(data_bytes)
+    if _ascii_compatible(enc):
+        src=data_bytes; T=bytes
+    else:
+        src,enc,bom=_opf_text(data_bytes); T=str
+    m=_METADATA_RE[T].search(src)
     if not m:
         raise RuntimeError("OPF缺少metadata")
-    body=m.group('body')
-    if write_calibre:
-        body=re.sub(r'\s*<\s*calibre:series\b[^>]*>.*?</\s*calibre:series\s*>\s*', '', body, flags=re.IGNORECASE|re.DOTALL)
-        body=re.sub(r'\s*<\s*calibre:series_index\b[^>]*>.*?</\s*calibre:series_index\s*>\s*', '', body, flags=re.IGNORECASE|re.DOTALL)
-        body=re.sub(r'\s*<\s*meta\b[^>]*\bname\s*=\s*"(?:calibre:series|calibre:series_index)"[^>]*\/>\s*', '', body, flags=re.IGNORECASE)
-        body=re.sub(r'\s*<\s*meta\b[^>]*\bproperty\s*=\s*"(?:calibre:series|calibre:series_index)"[^>]*>.*?</\s*meta\s*>\s*', '', body, flags=re.IGNORECASE|re.DOTALL)
-    if write_collection:
-        body=re.sub(r'\s*<\s*meta\b[^>]*\bproperty\s*=\s*"belongs-to-collection"[^>]*\/>\s*', '', body, flags=re.IGNORECASE)
-        body=re.sub(r'\s*<\s*meta\b[^>]*\bproperty\s*=\s*"belongs-to-collection"[^>]*>.*?</\s*meta\s*>\s*', '', body, flags=re.IGNORECASE|re.DOTALL)
-        body=re.sub(r'\s*<\s*meta\b[^>]*\bproperty\s*=\s*"(?:collection-type|group-position)"[^>]*\/>\s*', '', body, flags=re.IGNORECASE)
-        body=re.sub(r'\s*<\s*meta\b[^>]*\bproperty\s*=\s*"(?:collection-type|group-position)"[^>]*>.*?</\s*meta\s*>\s*', '', body, flags=re.IGNORECASE|re.DOTALL)
+    body=strip_series_tags(m.group('body'), write_collection, write_calibre)
     # 计算缩进（若存在换行，则取下一行的缩进；否则用两个空格）
-    sample=body[:200]
-    mi=re.match(r'\s*\n([ \t]*)', sample)
+    mi=_INDENT_RE[T].match(body[:200])
     indent=mi.group(1) if mi else '  '
+    if isinstance(indent,bytes): indent=indent.decode('ascii')
     ins=""
+    for e in edits:
+        body,add=apply_field_edit(body,e,enc,indent)
+        ins+=add
     if write_collection:
-        rid=f"col{random.randint(10000,99999)}"
+        # id 由系列名确定，重复运行得到相同的输出
+        rid=f"col{int(hashlib.sha1(series.encode('utf-8')).hexdigest(),16)%90000+10000}"
         ins+=f"\n{indent}<meta property=\"belongs-to-collection\" id=\"{rid}\">{xml_escape(series)}</meta>"
         ins+=f"\n{indent}<meta refines=\"#{rid}\" property=\"collection-type\">series</meta>"
         if index is not None:
@@ -709,10 +2508,15 @@ def inject_series_minimal(data_bytes, series, index=None, write_collection=True,
         if index is not None:
             ins+=f"\n{indent}<meta name=\"calibre:series_index\" content=\"{index}\" />"
     # 如果原body不是以换行开始，则在插入片段后补一个换行，保证下一标签独立一行
-    starts_nl = body.startswith('\n') or body.startswith('\r\n')
-    post = '' if starts_nl else '\n'
-    new_body=ins+post+body
-    new_s=s[:m.start('body')] + new_body + s[m.end('body'):]
-    return new_s.encode('utf-8')
+    starts_nl = body[:1]==src[:0]+('\n' if T is str else b'\n') or body[:2]==('\r\n' if T is str else b'\r\n')
+    post = '' if starts_nl or not ins else '\n'
+    if T is bytes:
+        # 原编码无法表示的字符写为字符引用
+        mv=memoryview(data_bytes)
+        return b''.join((mv[:m.start('body')], (ins+post).encode(enc,'xmlcharrefreplace'), body, mv[m.end('body'):]))
+    new_s=src[:m.start('body')] + ins + post + body + src[m.end('body'):]
+    return bom+new_s.encode(enc)
+def inject_series_minimal(data_bytes, series, index=None, write_collection=True, write_calibre=False):
+    return edit_opf_minimal(data_bytes, (), series, index, write_collection, write_calibre)
 
 if __name__=="__main__": main()